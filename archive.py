@@ -6,7 +6,7 @@ from SCons.Errors import BuildError
 from SCons import Action
 
 """
-Scons zip/tar/tar.bz2/tar.gz Builder
+Scons zip/tar/tar.bz2/tar.gz/tar.xz/tar.zst/tar.lz4 Builder
 
 This aims at allowing the user to easily create an archive of a few files. It is not meant to replace the
 packaging capabilities of the bundled package builders, but is rather intended to be used in situations where
@@ -36,48 +36,918 @@ You can set the following Environment options to affect the behavior of this Too
 	                                            # 'some_sub_dir/bar.xy' will be added to the archive
 	                                            # as 'foo/some_sub_dir/bar.xy'
 	env.SetDefault(ARCHIVE_VERBOSE = True)      # print all filenames as they are added
+	env.SetDefault(ARCHIVE_LEVEL = None)        # compression level, None uses the default of
+	                                            # the format (9 for gz and bz2, 6 for xz, 3 for
+	                                            # zst, 0 for lz4, zlib's default for zip)
+	env.SetDefault(ARCHIVE_JOBS = 1)            # number of threads used to compress .zip, .tar.gz
+	                                            # and .tar.bz2 archives. 0 uses one per cpu core
+	env.SetDefault(ARCHIVE_BLOCK_SIZE = None)   # size of the blocks handed to each thread, None
+	                                            # picks a default suitable for the format
+	env.SetDefault(ARCHIVE_CHUNK_SIZE = 1024 * 1024)  # members are read and the archive is
+	                                            # written in chunks of this size
+	env.SetDefault(ARCHIVE_FSYNC = False)       # fsync the archive before finishing the build
+	env.SetDefault(ARCHIVE_INCREMENTAL = False) # update .zip and .tar archives in place, see below
+	env.SetDefault(ARCHIVE_CACHE_DIR = None)    # directory caching compressed members, see below
+	env.SetDefault(ARCHIVE_CACHE_SIZE = 1024 ** 3)  # size limit of the cache directory in bytes
+	env.SetDefault(ARCHIVE_REPRODUCIBLE = False)  # write byte-identical archives, see below
+	env.SetDefault(ARCHIVE_MTIME = None)        # mtime of reproducible archive members, None uses
+	                                            # $SOURCE_DATE_EPOCH or else 1980-01-01
+
+With ARCHIVE_JOBS > 1, .tar.gz files are compressed pigz-style: the tar stream is cut into
+blocks that are deflated concurrently and joined into a single gzip member. .tar.bz2 files
+consist of one bzip2 stream per block, as written by pbzip2 (note that the bz2 module of
+Python 2 only reads the first of these streams, the bzip2 utility and Python 3 read all).
+Members of .zip files are deflated block-wise in the same fashion as .tar.gz files.
+
+.tar.xz, .tar.zst and .tar.lz4 files require the lzma (or backports.lzma), zstandard and lz4
+modules respectively. zstd compresses on ARCHIVE_JOBS threads by itself.
+
+Member data is streamed in chunks of ARCHIVE_CHUNK_SIZE, so memory usage stays bounded no
+matter how large the archived files are.
+
+Incremental updates:
+--------------------
+With ARCHIVE_INCREMENTAL set, the content signature of every source is recorded in the
+archive, in a zip extra field or in a tar pax header that other tools read as the extended
+attribute user.scons.csig (restored only by tar --xattrs and similar). On the next
+build, members whose source still has the same signature are copied verbatim, including
+their compressed data, from the previous archive; only changed files are read and
+compressed again. Reused members keep the metadata (mtime, mode) of the build that added
+them. This works for .zip and uncompressed .tar files, the target is marked as Precious so
+SCons keeps the previous archive around.
+
+Compressed member cache:
+------------------------
+Setting ARCHIVE_CACHE_DIR enables a cache of deflate streams, keyed by the content signature
+of a source and the compression level. It can be shared by any number of archives (and
+builds): a file is compressed once and its stream is spliced into every deflated .zip member
+and .tar.gz file needing it. .tar.gz files are always written block-wise (see ARCHIVE_JOBS)
+when the cache is used. Least recently used entries are removed once the cache grows beyond
+ARCHIVE_CACHE_SIZE.
+
+Reproducible archives:
+----------------------
+With ARCHIVE_REPRODUCIBLE set, building an archive from the same files yields the same bytes,
+independent of the time of the build, the user running it, the number of ARCHIVE_JOBS and
+the use of ARCHIVE_CACHE_DIR: members, including the contents of directories, are sorted
+by name and get a fixed mtime (ARCHIVE_MTIME), owner root and permissions 0644 (0755 for
+directories and executables). gzip headers carry no timestamp. .tar.gz files and deflated
+.zip members are always written block-wise, so the output does not depend on the number of
+threads, only on ARCHIVE_BLOCK_SIZE. .tar.bz2 files are written as a single stream on one
+thread, ignoring ARCHIVE_JOBS. Identical archives let CacheDir and other content-addressed
+caches downstream hit.
 """
 
 try:
 	import os
 	import os.path
+	import stat
 	import zipfile
 	import tarfile
+	import time
+	import struct
+	import zlib
+	import bz2
+	import collections
+	import copy
+	import tempfile
+	import multiprocessing
+	from multiprocessing.pool import ThreadPool
 except ImportError:
 	def exists(env): return False
 else:
 	def exists(env): return True
 
+# optional compression backends
+try:
+	import lzma
+except ImportError:
+	try:
+		from backports import lzma
+	except ImportError:
+		lzma = None
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+try:
+	import lz4.frame
+except ImportError:
+	lz4 = None
+
 def generate(env):
 	assert(exists(env))
-	bld = Builder(action = Action.Action(archive, archive_string))
+	action = Action.Action(archive, archive_string,
+	                       varlist = ['ARCHIVE_LEVEL', 'ARCHIVE_ZIP_METHOD',
+	                                  'ARCHIVE_REPRODUCIBLE', '_ARCHIVE_SIGNATURE_MTIME'])
+	bld = Builder(action = action, emitter = archive_emitter)
 	env.Append(BUILDERS = {'Archive': bld})
 	env.SetDefault(ARCHIVE_ZIP_METHOD = 'ZIP_DEFLATED')
 	env.SetDefault(ARCHIVE_PREFIX = None)
 	env.SetDefault(ARCHIVE_VERBOSE = True)
+	env.SetDefault(ARCHIVE_LEVEL = None)
+	env.SetDefault(ARCHIVE_JOBS = 1)
+	env.SetDefault(ARCHIVE_BLOCK_SIZE = None)
+	env.SetDefault(ARCHIVE_CHUNK_SIZE = 1024 * 1024)
+	env.SetDefault(ARCHIVE_FSYNC = False)
+	env.SetDefault(ARCHIVE_INCREMENTAL = False)
+	env.SetDefault(ARCHIVE_CACHE_DIR = None)
+	env.SetDefault(ARCHIVE_CACHE_SIZE = 1024 ** 3)
+	env.SetDefault(ARCHIVE_REPRODUCIBLE = False)
+	env.SetDefault(ARCHIVE_MTIME = None)
+	env.SetDefault(_ARCHIVE_SIGNATURE_MTIME = archive_signature_mtime)
+
+def archive_emitter(target, source, env):
+	if env['ARCHIVE_INCREMENTAL']:
+		# the previous archive is needed to update it
+		env.Precious(target)
+	return target, source
+
+def archive_jobs(env):
+	try:
+		jobs = int(env['ARCHIVE_JOBS'])
+	except ValueError:
+		raise BuildError(errstr = 'Not a valid number of jobs: %s' % env['ARCHIVE_JOBS'])
+	return jobs if jobs > 0 else multiprocessing.cpu_count()
+
+def archive_chunk_size(env):
+	return int(env['ARCHIVE_CHUNK_SIZE'])
+
+# the earliest date a zip file can represent
+DEFAULT_MTIME = 315532800
+
+def archive_mtime(env):
+	mtime = env['ARCHIVE_MTIME']
+	if mtime is None:
+		mtime = env['ENV'].get('SOURCE_DATE_EPOCH', os.environ.get('SOURCE_DATE_EPOCH'))
+	if mtime is None:
+		return DEFAULT_MTIME
+	try:
+		return int(mtime)
+	except ValueError:
+		raise BuildError(errstr = 'Not a valid mtime: %s' % mtime)
+
+def archive_signature_mtime(target, source, env, for_signature):
+	# the mtime given to members, including one from SOURCE_DATE_EPOCH, is part of the
+	# signature of reproducible archives
+	return str(archive_mtime(env)) if env['ARCHIVE_REPRODUCIBLE'] else ''
+
+def normalized_mode(mode, isdir):
+	return 0o755 if isdir or mode & 0o111 else 0o644
+
+DEFAULT_LEVELS = {
+	'zip': zlib.Z_DEFAULT_COMPRESSION,
+	'gz': 9,
+	'bz2': 9,
+	'xz': 6,
+	'zst': 3,
+	'lz4': 0,
+}
+
+def archive_level(env, compression_mode):
+	if env['ARCHIVE_LEVEL'] is None:
+		return DEFAULT_LEVELS[compression_mode]
+	try:
+		return int(env['ARCHIVE_LEVEL'])
+	except ValueError:
+		raise BuildError(errstr = 'Not a valid compression level: %s' % env['ARCHIVE_LEVEL'])
+
+# a final, empty fixed huffman deflate block. appended to a stream of Z_SYNC_FLUSHed
+# blocks it terminates the stream
+DEFLATE_END = b'\x03\x00'
+
+def deflate_block(data, level):
+	compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+	return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+def bzip2_block(data, level):
+	return bz2.compress(data, level)
+
+def gf2_matrix_times(mat, vec):
+	total = 0
+	for row in mat:
+		if not vec:
+			break
+		if vec & 1:
+			total ^= row
+		vec >>= 1
+	return total
+
+def gf2_matrix_square(mat):
+	return [gf2_matrix_times(mat, row) for row in mat]
+
+CRC32_SHIFTS = None
+
+def crc32_shift_matrices():
+	"""Returns the operators appending 2**n zero bytes to a crc32, as used by zlib's
+	crc32_combine."""
+	global CRC32_SHIFTS
+	if CRC32_SHIFTS is None:
+		# operator for a single zero bit, squared three times to get one for a byte
+		mat = [0xedb88320] + [1 << n for n in range(31)]
+		for i in range(3):
+			mat = gf2_matrix_square(mat)
+		shifts = []
+		for i in range(64):
+			shifts.append(mat)
+			mat = gf2_matrix_square(mat)
+		CRC32_SHIFTS = shifts
+	return CRC32_SHIFTS
+
+def crc32_combine(crc1, crc2, length2):
+	"""Returns the crc32 of two concatenated strings, given the crc32 of both and the
+	length of the second one."""
+	crc1 &= 0xffffffff
+	for mat in crc32_shift_matrices():
+		if not length2:
+			break
+		if length2 & 1:
+			crc1 = gf2_matrix_times(mat, crc1)
+		length2 >>= 1
+	return crc1 ^ (crc2 & 0xffffffff)
+
+class BlockPipeline(object):
+	"""Runs compression jobs on a pool of threads (zlib and bz2 release the GIL while
+	compressing), writing the results to fileobj in the order they were submitted. With a
+	single job, everything is run right away on the calling thread instead.
+
+	At most two blocks per thread are kept in flight, so memory usage does not depend on
+	the amount of data passing through."""
+	def __init__(self, fileobj, jobs):
+		self.fileobj = fileobj
+		self.jobs = jobs
+		self.pool = ThreadPool(jobs) if jobs > 1 else None
+		self.pending = collections.deque()
+		# file objects receiving a copy of every result, see CacheEntryWriter
+		self.sinks = []
+
+	def submit(self, func, *args):
+		if not self.pool:
+			self.write(func(*args))
+			return
+		self.enqueue(self.pool.apply_async(func, args))
+
+	def write(self, data):
+		self.fileobj.write(data)
+		for sink in self.sinks:
+			sink.write(data)
+
+	def call(self, func, *args):
+		"""Calls func once all previously submitted results are written."""
+		if not self.pool:
+			func(*args)
+			return
+		self.enqueue((func, args))
+
+	def enqueue(self, item):
+		self.pending.append(item)
+		while len(self.pending) > 2 * self.jobs:
+			self.write_next()
+
+	def write_next(self):
+		item = self.pending.popleft()
+		if isinstance(item, tuple):
+			func, args = item
+			func(*args)
+		else:
+			self.write(item.get())
+
+	def drain(self):
+		while self.pending:
+			self.write_next()
+
+	def close(self):
+		self.drain()
+		if self.pool:
+			self.pool.close()
+			self.pool.join()
+
+class BlockCompressedFile(object):
+	"""Write-only file object that cuts its input into blocks of block_size bytes and
+	compresses those concurrently."""
+	block_size = 128 * 1024
+
+	def __init__(self, fileobj, jobs, level = 9, block_size = None):
+		self.fileobj = fileobj
+		self.level = level
+		self.block_size = block_size or self.block_size
+		self.pipeline = BlockPipeline(fileobj, jobs)
+		self.buf = []
+		self.buffered = 0
+		self.position = 0
+		self.fileobj.write(self.header())
+
+	def tell(self):
+		return self.position
+
+	def write(self, data):
+		self.position += len(data)
+		self.buf.append(data)
+		self.buffered += len(data)
+		if self.buffered >= self.block_size:
+			data = b''.join(self.buf)
+			end = len(data) - len(data) % self.block_size
+			for offset in range(0, end, self.block_size):
+				self.submit(data[offset:offset + self.block_size])
+			self.buf = [data[end:]]
+			self.buffered = len(data) - end
+
+	def flush(self):
+		"""Compresses all buffered data, ending the current block."""
+		if self.buffered:
+			self.submit(b''.join(self.buf))
+		self.buf = []
+		self.buffered = 0
+
+	def close(self):
+		self.flush()
+		self.pipeline.close()
+		self.fileobj.write(self.trailer())
+
+	def header(self):
+		return b''
+
+	def trailer(self):
+		return b''
+
+class ParallelGzipFile(BlockCompressedFile):
+	"""Writes a single gzip member whose deflate stream is made up of independently
+	compressed blocks, each ending on a byte boundary through Z_SYNC_FLUSH."""
+	def __init__(self, *args, **kwargs):
+		self.crc = 0
+		self.size = 0
+		self.mtime = kwargs.pop('mtime', None)
+		BlockCompressedFile.__init__(self, *args, **kwargs)
+
+	def submit(self, data):
+		self.crc = zlib.crc32(data, self.crc)
+		self.size += len(data)
+		self.pipeline.submit(deflate_block, data, self.level)
+
+	def splice(self, stream):
+		"""Inserts a CachedStream as if its uncompressed data had been written."""
+		self.flush()
+		self.crc = crc32_combine(self.crc, stream.crc, stream.size)
+		self.size += stream.size
+		self.position += stream.size
+		self.pipeline.call(stream.copy_to, self.fileobj)
+
+	def start_capture(self, entry):
+		"""Copies the compressed form of everything written from now on to entry."""
+		self.flush()
+		self.pipeline.call(self.pipeline.sinks.append, entry)
+
+	def finish_capture(self, entry, crc, size):
+		self.flush()
+		self.pipeline.call(self.pipeline.sinks.remove, entry)
+		self.pipeline.call(entry.commit, crc, size)
+
+	def header(self):
+		# magic, deflate, no flags, mtime, extra flags, unknown os
+		xfl = {9: 2, 1: 4}.get(self.level, 0)
+		mtime = int(time.time()) if self.mtime is None else self.mtime
+		return struct.pack('<BBBBIBB', 0x1f, 0x8b, 8, 0, mtime, xfl, 255)
+
+	def trailer(self):
+		return DEFLATE_END + struct.pack('<II', self.crc & 0xffffffff, self.size & 0xffffffff)
+
+class ParallelBZ2File(BlockCompressedFile):
+	"""Writes one complete bzip2 stream per block."""
+	block_size = 900 * 1000
+
+	def submit(self, data):
+		self.pipeline.submit(bzip2_block, data, self.level)
+
+class CachedStream(object):
+	"""A deflate stream read from the cache."""
+	def __init__(self, path, chunk_size):
+		self.f = open(path, 'rb')
+		self.crc, self.size = struct.unpack(DeflateCache.header_format,
+		                                    self.f.read(DeflateCache.header_size))
+		self.chunk_size = chunk_size
+
+	def copy_to(self, dst):
+		for chunk in read_chunks(self.f, self.chunk_size):
+			dst.write(chunk)
+		self.close()
+
+	def close(self):
+		self.f.close()
+
+class CacheEntryWriter(object):
+	"""Receives a deflate stream and moves it into the cache on commit."""
+	def __init__(self, path):
+		self.path = path
+		directory = os.path.dirname(path)
+		if not os.path.isdir(directory):
+			try:
+				os.makedirs(directory)
+			except OSError:
+				# created concurrently
+				pass
+		fd, self.tmp_path = tempfile.mkstemp(dir = directory, suffix = '.tmp')
+		self.f = os.fdopen(fd, 'wb')
+		self.f.write(b'\0' * DeflateCache.header_size)
+
+	def write(self, data):
+		self.f.write(data)
+
+	def commit(self, crc, size):
+		self.f.seek(0)
+		self.f.write(struct.pack(DeflateCache.header_format, crc & 0xffffffff, size))
+		self.f.close()
+		try:
+			os.rename(self.tmp_path, self.path)
+		except OSError:
+			# another build stored the same stream first
+			os.remove(self.tmp_path)
+
+class DeflateCache(object):
+	"""Content-addressed store of raw deflate streams. Streams are made up of Z_SYNC_FLUSHed
+	blocks without a final one, so they can be spliced into any other deflate stream.
+
+	Each entry starts with the crc32 and size of the uncompressed data. Entries are touched
+	on use, eviction removes those with the oldest mtime."""
+	header_format = '<IQ'
+	header_size = struct.calcsize(header_format)
+
+	def __init__(self, path, max_size, chunk_size):
+		self.path = path
+		self.max_size = max_size
+		self.chunk_size = chunk_size
+
+	def entry_path(self, csig, level, block_size):
+		return os.path.join(self.path, csig[:2],
+		                    '%s-deflate-%d-%d' % (csig, level, block_size))
+
+	def get(self, csig, level, block_size):
+		path = self.entry_path(csig, level, block_size)
+		counts = DEFLATE_CACHE_STATS.setdefault(self.path, {'hits': 0, 'misses': 0})
+		try:
+			stream = CachedStream(path, self.chunk_size)
+			os.utime(path, None)
+		except (IOError, OSError):
+			counts['misses'] += 1
+			return None
+		counts['hits'] += 1
+		return stream
+
+	def create(self, csig, level, block_size):
+		return CacheEntryWriter(self.entry_path(csig, level, block_size))
+
+	def evict(self):
+		entries = []
+		total = 0
+		for dirpath, dirnames, filenames in os.walk(self.path):
+			for filename in filenames:
+				path = os.path.join(dirpath, filename)
+				try:
+					st = os.stat(path)
+				except OSError:
+					continue
+				entries.append((st.st_mtime, st.st_size, path))
+				total += st.st_size
+
+		entries.sort()
+		for mtime, size, path in entries:
+			if total <= self.max_size:
+				break
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+			total -= size
+
+# hits and misses per cache directory, reported by cache_stats for the buildstats tool
+# kept when SCons loads the tool again for another environment
+DEFLATE_CACHE_STATS = globals().get('DEFLATE_CACHE_STATS', {})
+
+def cache_stats():
+	return dict(('archive deflate cache %s' % path, dict(counts))
+	            for path, counts in DEFLATE_CACHE_STATS.items())
+
+def archive_cache(env):
+	if not env['ARCHIVE_CACHE_DIR']:
+		return None
+	return DeflateCache(env.Dir(env['ARCHIVE_CACHE_DIR']).get_abspath(),
+	                    int(env['ARCHIVE_CACHE_SIZE']), archive_chunk_size(env))
+
+def xz_file(fileobj, jobs, level):
+	if not lzma:
+		raise BuildError(errstr = 'Writing .tar.xz files requires the lzma module')
+	return lzma.LZMAFile(fileobj, 'w', preset = level)
+
+class ZstdFile(object):
+	"""Write-only file object writing a single zstd frame, compressed by jobs threads."""
+	def __init__(self, fileobj, jobs, level):
+		if not zstandard:
+			raise BuildError(errstr = 'Writing .tar.zst files requires the zstandard module')
+		# with at least one worker thread, the output is the same for any number of threads
+		compressor = zstandard.ZstdCompressor(level = level, threads = jobs)
+		self.writer = compressor.stream_writer(fileobj)
+
+	def write(self, data):
+		self.writer.write(data)
+
+	def close(self):
+		# ends the frame, without closing fileobj
+		self.writer.flush(zstandard.FLUSH_FRAME)
+
+class BZ2StreamFile(object):
+	"""Write-only file object writing a single bzip2 stream. Unlike tarfile's own bz2
+	support on python 2, it honours the compression level."""
+	def __init__(self, fileobj, jobs, level):
+		self.fileobj = fileobj
+		self.compressor = bz2.BZ2Compressor(level)
+
+	def write(self, data):
+		self.fileobj.write(self.compressor.compress(data))
+
+	def close(self):
+		# ends the stream, without closing fileobj
+		self.fileobj.write(self.compressor.flush())
+
+def lz4_file(fileobj, jobs, level):
+	if not lz4:
+		raise BuildError(errstr = 'Writing .tar.lz4 files requires the lz4 module')
+	return lz4.frame.LZ4FrameFile(fileobj, 'wb', compression_level = level)
+
+def open_output(env, output_filename):
+	return open(output_filename, 'wb', archive_chunk_size(env))
+
+def close_output(env, outfile):
+	outfile.flush()
+	if env['ARCHIVE_FSYNC']:
+		os.fsync(outfile.fileno())
+	outfile.close()
+
+def read_chunks(f, chunk_size):
+	return iter(lambda: f.read(chunk_size), b'')
+
+def copy_range(src, dst, start, length, chunk_size):
+	src.seek(start)
+	while length > 0:
+		chunk = src.read(min(chunk_size, length))
+		if not chunk:
+			raise BuildError(errstr = 'Previous archive is truncated: %s' % src.name)
+		dst.write(chunk)
+		length -= len(chunk)
+
+# zip extra field holding the content signature of a member's source
+CSIG_EXTRA_ID = 0x5343
+
+def csig_extra(csig):
+	csig = csig.encode('ascii')
+	return struct.pack('<HH', CSIG_EXTRA_ID, len(csig)) + csig
+
+def extra_csig(extra):
+	while len(extra) >= 4:
+		field_id, length = struct.unpack('<HH', extra[:4])
+		if field_id == CSIG_EXTRA_ID:
+			return extra[4:4 + length].decode('ascii')
+		extra = extra[4 + length:]
+
+# pax header keyword holding the content signature of a member's source. GNU tar
+# warns about unknown keywords, but takes SCHILY.xattr.* for an extended attribute
+# and skips it unless extracting with --xattrs
+CSIG_PAX_KEYWORD = 'SCHILY.xattr.user.scons.csig'
 
 class ZipWriter(object):
-	def __init__(self, env, output_filename):
+	block_size = 128 * 1024
+
+	def __init__(self, env, output_filename, previous = None):
+		self.env = env
 		try:
-			self.ziparchive = zipfile.ZipFile(output_filename, 'w', getattr(zipfile, env['ARCHIVE_ZIP_METHOD']))
+			self.method = getattr(zipfile, env['ARCHIVE_ZIP_METHOD'])
 		except AttributeError:
 			raise BuildError(errstr = 'Not a valid zip method: %s' % env['ARCHIVE_ZIP_METHOD'])
 
-	def add(self, filename, archive_filename):
-		self.ziparchive.write(filename, archive_filename)
+		self.outfile = open_output(env, output_filename)
+		self.ziparchive = zipfile.ZipFile(self.outfile, 'w', self.method)
+
+		# without parallel compression, members are read in chunks of ARCHIVE_CHUNK_SIZE
+		# and streamed through a single compressor each
+		jobs = archive_jobs(env) if self.method == zipfile.ZIP_DEFLATED else 1
+		self.pipeline = BlockPipeline(self.outfile, jobs)
+		self.level = archive_level(env, 'zip')
+		self.chunk_size = archive_chunk_size(env)
+		self.block_size = env['ARCHIVE_BLOCK_SIZE'] or self.block_size
+
+		self.incremental = env['ARCHIVE_INCREMENTAL']
+		self.reproducible = env['ARCHIVE_REPRODUCIBLE']
+		if self.reproducible:
+			self.mtime = archive_mtime(env)
+		self.cache = archive_cache(env) if self.method == zipfile.ZIP_DEFLATED else None
+
+		self.previous = None
+		self.reusable = {}
+		if previous:
+			self.previous = zipfile.ZipFile(previous)
+			for zinfo in self.previous.infolist():
+				# members written with a data descriptor cannot be copied as is
+				if zinfo.compress_type == self.method and not zinfo.flag_bits & 0x08:
+					self.reusable[zinfo.filename] = zinfo
+
+	def add(self, filename, archive_filename, csig = None):
+		if os.path.isdir(filename):
+			self.pipeline.drain()
+			if self.reproducible:
+				zinfo = zipfile.ZipInfo(archive_filename.rstrip(os.sep) + '/',
+				                        time.gmtime(self.mtime)[0:6])
+				zinfo.external_attr = (stat.S_IFDIR | normalized_mode(0, True)) << 16 | 0x10
+				self.ziparchive.writestr(zinfo, b'')
+			else:
+				self.ziparchive.write(filename, archive_filename)
+			return
+
+		if csig and self.incremental and self.reuse(archive_filename, csig):
+			return
+
+		st = os.stat(filename)
+		if self.reproducible:
+			zinfo = zipfile.ZipInfo(archive_filename, time.gmtime(self.mtime)[0:6])
+			zinfo.external_attr = (stat.S_IFREG | normalized_mode(st.st_mode, False)) << 16
+		else:
+			zinfo = zipfile.ZipInfo(archive_filename, time.localtime(st.st_mtime)[0:6])
+			zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
+		zinfo.compress_type = self.method
+		zinfo.CRC = zinfo.file_size = zinfo.compress_size = 0
+		if csig and self.incremental:
+			zinfo.extra = csig_extra(csig)
+		zip64 = st.st_size > zipfile.ZIP64_LIMIT
+		level = self.level
+
+		entry = None
+		if csig and self.cache:
+			stream = self.cache.get(csig, level, self.block_size)
+			if stream and stream.size == st.st_size:
+				self.pipeline.call(self.start_member, zinfo, self.local_header(zinfo, zip64))
+				zinfo.CRC, zinfo.file_size = stream.crc, stream.size
+				self.pipeline.call(stream.copy_to, self.outfile)
+				self.pipeline.call(self.finish_member, zinfo, zip64, lambda: DEFLATE_END)
+				return
+			elif stream:
+				stream.close()
+			entry = self.cache.create(csig, level, self.block_size)
+
+		chunk_size = self.chunk_size
+		if self.method != zipfile.ZIP_DEFLATED:
+			encode, end = None, lambda: b''
+		elif self.pipeline.pool or entry or self.reproducible:
+			# blocks can be cached, as they end on a byte boundary, and do not depend on
+			# the number of threads
+			encode, end = deflate_block, lambda: DEFLATE_END
+			chunk_size = self.block_size
+		else:
+			compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+			encode, end = lambda data, level: compressor.compress(data), compressor.flush
+
+		self.pipeline.call(self.start_member, zinfo, self.local_header(zinfo, zip64))
+		if entry:
+			self.pipeline.call(self.pipeline.sinks.append, entry)
+		crc = file_size = 0
+		with open(filename, 'rb') as f:
+			for block in read_chunks(f, chunk_size):
+				crc = zlib.crc32(block, crc) & 0xffffffff
+				file_size += len(block)
+				if encode:
+					self.pipeline.submit(encode, block, level)
+				else:
+					self.pipeline.call(self.outfile.write, block)
+		# zinfo is only completed now, the calls queued above must not see it half done
+		zinfo.CRC, zinfo.file_size = crc, file_size
+		if entry:
+			self.pipeline.call(self.pipeline.sinks.remove, entry)
+			self.pipeline.call(entry.commit, zinfo.CRC, zinfo.file_size)
+		self.pipeline.call(self.finish_member, zinfo, zip64, end)
+
+	def reuse(self, archive_filename, csig):
+		zinfo = self.reusable.get(zipfile.ZipInfo(archive_filename).filename)
+		if not zinfo or extra_csig(zinfo.extra) != csig:
+			return False
+		self.pipeline.call(self.copy_member, zinfo)
+		return True
+
+	def copy_member(self, zinfo):
+		fp = self.previous.fp
+		fp.seek(zinfo.header_offset)
+		name_length, extra_length = struct.unpack('<26xHH', fp.read(30))
+		length = 30 + name_length + extra_length + zinfo.compress_size
+
+		offset = self.outfile.tell()
+		copy_range(fp, self.outfile, zinfo.header_offset, length, self.chunk_size)
+		zinfo.header_offset = offset
+		self.register_member(zinfo)
+
+	def register_member(self, zinfo):
+		# register the member with the ZipFile, so it ends up in the central directory
+		self.ziparchive.filelist.append(zinfo)
+		self.ziparchive.NameToInfo[zinfo.filename] = zinfo
+		self.ziparchive._didModify = True
+		self.ziparchive.start_dir = self.outfile.tell()
+
+	def local_header(self, zinfo, zip64):
+		# the header written first, with crc and sizes zeroed; finish_member rewrites it
+		blank = copy.copy(zinfo)
+		blank.CRC = blank.file_size = blank.compress_size = 0
+		return blank.FileHeader(zip64)
+
+	def start_member(self, zinfo, header):
+		zinfo.header_offset = self.outfile.tell()
+		self.outfile.write(header)
+
+	def finish_member(self, zinfo, zip64, end):
+		fp = self.outfile
+		fp.write(end())
+		end = fp.tell()
+		zinfo.compress_size = end - zinfo.header_offset - len(zinfo.FileHeader(zip64))
+		if not zip64 and max(zinfo.file_size, zinfo.compress_size) > zipfile.ZIP64_LIMIT:
+			raise BuildError(errstr = 'File size exceeded zip64 limit: %s' % zinfo.filename)
+
+		# now that sizes and crc are known, rewrite the local header in place
+		fp.seek(zinfo.header_offset)
+		fp.write(zinfo.FileHeader(zip64))
+		fp.seek(end)
+		self.register_member(zinfo)
 
 	def finish(self):
+		self.pipeline.close()
 		self.ziparchive.close()
+		close_output(self.env, self.outfile)
+		if self.previous:
+			self.previous.close()
+		if self.cache:
+			self.cache.evict()
 
 class TarWriter(object):
-	def __init__(self, env, output_filename, compression_mode = ''):
-		self.tararchive = tarfile.open(output_filename, 'w:%s' % compression_mode)
+	parallel_files = {
+		'gz': ParallelGzipFile,
+		'bz2': ParallelBZ2File,
+	}
+
+	stream_files = {
+		'bz2': BZ2StreamFile,
+		'xz': xz_file,
+		'zst': ZstdFile,
+		'lz4': lz4_file,
+	}
+
+	def __init__(self, env, output_filename, compression_mode = '', previous = None):
+		self.env = env
+		self.chunk_size = archive_chunk_size(env)
+		self.outfile = open_output(env, output_filename)
+		self.compressed = None
+		self.member_blocks = False
+		self.incremental = env['ARCHIVE_INCREMENTAL'] and not compression_mode
+		self.cache = archive_cache(env) if compression_mode == 'gz' else None
+		self.reproducible = env['ARCHIVE_REPRODUCIBLE']
+		if self.reproducible:
+			self.mtime = archive_mtime(env)
+
+		jobs = archive_jobs(env)
+		if self.reproducible and compression_mode == 'bz2':
+			# a single bzip2 stream is deterministic by itself; unlike one stream per block,
+			# python 2's tarfile can read it
+			jobs = 1
+		level = archive_level(env, compression_mode) if compression_mode else None
+		if (jobs > 1 or self.cache or (self.reproducible and compression_mode == 'gz')) and \
+		   compression_mode in self.parallel_files:
+			kwargs = {'block_size': env['ARCHIVE_BLOCK_SIZE']}
+			if self.reproducible and compression_mode == 'gz':
+				# no timestamp in the gzip header
+				kwargs['mtime'] = 0
+			self.compressed = self.parallel_files[compression_mode](
+				self.outfile, jobs, level, **kwargs)
+			self.tararchive = tarfile.open(fileobj = self.compressed, mode = 'w')
+			# cut blocks at member boundaries for cached (and, as their output must not
+			# depend on the cache, for reproducible) .tar.gz files
+			self.member_blocks = compression_mode == 'gz'
+		elif compression_mode in self.stream_files:
+			self.compressed = self.stream_files[compression_mode](self.outfile, jobs, level)
+			self.tararchive = tarfile.open(fileobj = self.compressed, mode = 'w|',
+			                               bufsize = self.chunk_size)
+		elif self.incremental:
+			# content signatures are stored in pax headers
+			self.tararchive = tarfile.open(fileobj = self.outfile, mode = 'w',
+			                               format = tarfile.PAX_FORMAT)
+		elif compression_mode:
+			self.tararchive = tarfile.open(fileobj = self.outfile, mode = 'w:%s' % compression_mode,
+			                               compresslevel = level)
+		else:
+			self.tararchive = tarfile.open(fileobj = self.outfile, mode = 'w')
+
+		self.previous = None
+		self.reusable = {}
+		if previous:
+			self.previous = tarfile.open(previous)
+			for tarinfo in self.previous.getmembers():
+				if tarinfo.isreg() and CSIG_PAX_KEYWORD in tarinfo.pax_headers:
+					self.reusable[tarinfo.name] = tarinfo
 
-	def add(self, filename, archive_filename):
-		self.tararchive.add(filename, archive_filename)
+	def add(self, filename, archive_filename, csig = None):
+		tarinfo = self.tararchive.gettarinfo(filename, archive_filename)
+		if not tarinfo.isreg():
+			if self.reproducible:
+				self.tararchive.add(filename, archive_filename, recursive = False,
+				                    filter = self.normalize)
+			else:
+				self.tararchive.add(filename, archive_filename, recursive = False)
+			if tarinfo.isdir():
+				# tarfile walks directories in os.listdir order, which differs between
+				# file systems
+				for name in sorted(os.listdir(filename)):
+					self.add(os.path.join(filename, name), os.path.join(archive_filename, name))
+			return
+
+		if self.reproducible:
+			self.normalize(tarinfo)
+
+		if csig and self.incremental:
+			if self.reuse(tarinfo.name, csig):
+				return
+			tarinfo.pax_headers[CSIG_PAX_KEYWORD] = csig
+
+		# write the header through tarfile, but stream the data ourselves
+		self.tararchive.addfile(tarinfo)
+		dst = self.tararchive.fileobj
+		if not (csig and self.cache and self.splice_cached(csig, tarinfo.size)):
+			self.copy_data(filename, dst, tarinfo.size, csig)
+
+		blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+		if remainder:
+			dst.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+			blocks += 1
+		self.tararchive.offset += blocks * tarfile.BLOCKSIZE
+
+	def reuse(self, name, csig):
+		tarinfo = self.reusable.get(name)
+		if not tarinfo or tarinfo.pax_headers[CSIG_PAX_KEYWORD] != csig:
+			return False
+
+		# copy headers and padded data of the member
+		blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+		end = tarinfo.offset_data + (blocks + bool(remainder)) * tarfile.BLOCKSIZE
+		copy_range(self.previous.fileobj, self.tararchive.fileobj, tarinfo.offset,
+		           end - tarinfo.offset, self.chunk_size)
+		self.tararchive.offset += end - tarinfo.offset
+		self.tararchive.members.append(tarinfo)
+		return True
+
+	def normalize(self, tarinfo):
+		tarinfo.mtime = self.mtime
+		tarinfo.uid = tarinfo.gid = 0
+		tarinfo.uname = tarinfo.gname = 'root'
+		tarinfo.mode = normalized_mode(tarinfo.mode, tarinfo.isdir())
+		return tarinfo
+
+	def splice_cached(self, csig, size):
+		stream = self.cache.get(csig, self.compressed.level, self.compressed.block_size)
+		if not stream:
+			return False
+		if stream.size != size:
+			stream.close()
+			return False
+		self.compressed.splice(stream)
+		return True
+
+	def copy_data(self, filename, dst, size, csig):
+		entry = None
+		if csig and self.cache:
+			entry = self.cache.create(csig, self.compressed.level, self.compressed.block_size)
+			self.compressed.start_capture(entry)
+		elif self.member_blocks:
+			self.compressed.flush()
+
+		crc = 0
+		with open(filename, 'rb') as f:
+			copied = 0
+			while copied < size:
+				chunk = f.read(min(self.chunk_size, size - copied))
+				if not chunk:
+					break
+				if entry:
+					crc = zlib.crc32(chunk, crc)
+				dst.write(chunk)
+				copied += len(chunk)
+		if copied != size:
+			raise BuildError(errstr = 'File changed size while archiving: %s' % filename)
+
+		if entry:
+			self.compressed.finish_capture(entry, crc, size)
+		elif self.member_blocks:
+			self.compressed.flush()
 
 	def finish(self):
 		self.tararchive.close()
+		if self.compressed:
+			self.compressed.close()
+		close_output(self.env, self.outfile)
+		if self.previous:
+			self.previous.close()
+		if self.cache:
+			self.cache.evict()
 
 def archive_string(target, source, env):
 	return "Building %s from %d source files." % (target[0].get_path(), len(source))
@@ -86,23 +956,51 @@ def archive(target, source, env):
 	assert(len(target) == 1)
 	target_name = target[0].get_abspath()
 
+	previous = None
+	if env['ARCHIVE_INCREMENTAL'] and os.path.exists(target_name) and\
+	   (target_name.endswith('.zip') or target_name.endswith('.tar')):
+		previous = target_name + '.previous'
+		os.rename(target_name, previous)
+
+	try:
+		build_archive(target, source, env, previous)
+	finally:
+		if previous:
+			os.remove(previous)
+
+def build_archive(target, source, env, previous):
+	target_name = target[0].get_abspath()
+
 	if target_name.endswith('.zip'):
-		writer = ZipWriter(env, target_name)
+		writer = ZipWriter(env, target_name, previous)
 	elif target_name.endswith('.tar'):
-		writer = TarWriter(env, target_name)
+		writer = TarWriter(env, target_name, previous = previous)
 	elif target_name.endswith('.tar.bz2'):
 		writer = TarWriter(env, target_name, 'bz2')
 	elif target_name.endswith('.tar.gz'):
 		writer = TarWriter(env, target_name, 'gz')
+	elif target_name.endswith('.tar.xz'):
+		writer = TarWriter(env, target_name, 'xz')
+	elif target_name.endswith('.tar.zst'):
+		writer = TarWriter(env, target_name, 'zst')
+	elif target_name.endswith('.tar.lz4'):
+		writer = TarWriter(env, target_name, 'lz4')
 	else:
 		raise BuildError(errstr = "Unknown file extension: %s" % target_name)
 
 	target_relname = target[0].get_path()
-	for sourcefile in source:
-		archive_prefix = env['ARCHIVE_PREFIX'] or ''
-		archive_filename = os.path.join(archive_prefix, sourcefile.get_path())
+	archive_prefix = env['ARCHIVE_PREFIX'] or ''
+	members = [(os.path.join(archive_prefix, sourcefile.get_path()), sourcefile)
+	           for sourcefile in source]
+	if env['ARCHIVE_REPRODUCIBLE']:
+		members.sort(key = lambda member: member[0])
+
+	for archive_filename, sourcefile in members:
 		source_filename = sourcefile.get_abspath()
 		if env['ARCHIVE_VERBOSE']: print "%s => %s:%s" % (source_filename, target_relname, archive_filename)
-		writer.add(source_filename, archive_filename)
+		csig = None
+		if env['ARCHIVE_INCREMENTAL'] or env['ARCHIVE_CACHE_DIR']:
+			csig = sourcefile.get_csig()
+		writer.add(source_filename, archive_filename, csig)
 
 	writer.finish()
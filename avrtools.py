@@ -2,29 +2,276 @@
 # coding=utf8
 
 from SCons.Script import *
+from SCons.Errors import BuildError
+import SCons.Subst
+import atexit
+import json
+import os
+import subprocess
 
 cpu_freq_table = {
 	'atmega128': 7372800,
 	'atmega328p': 16*10**6,
 }
 
+# flash and ram in bytes, the default budgets of AVRSize
+memory_table = {
+	'atmega128': (128*1024, 4*1024),
+	'atmega328p': (32*1024, 2*1024),
+}
+
+# objects built with AVRLibrary go to $AVR_VARIANT_ROOT/<mcu>-<f_cpu>/<library>, so
+# environments for boards sharing MCU and clock share the objects and the library, as long
+# as their compiler flags are the same. Boards that differ only in pin assignments or
+# application code build the common libraries once
+def avr_variant_dir(env):
+	return env.Dir('$AVR_VARIANT_ROOT').Dir(env.subst('$AVR_MMCU-$AVR_F_CPU'))
+
+# SCons (on python 2) executes the tool module again for every environment loading it,
+# the registries below are kept across these reloads
+AVR_LIBRARIES = globals().get('AVR_LIBRARIES', {})
+
+def avr_library(env, name, source):
+	vdir = avr_variant_dir(env)
+	sources = [env.File(src) for src in env.Flatten([source])]
+	target = vdir.File(env.subst('${LIBPREFIX}%s${LIBSUFFIX}' % name))
+
+	# the second board asking for a library gets the nodes of the first one. Should the
+	# flags differ, SCons complains about the conflicting actions for the objects instead
+	flags = env.subst('$CCCOM $CXXCOM', SCons.Subst.SUBST_SIG)
+	key = (target, tuple(sources))
+	if key in AVR_LIBRARIES and AVR_LIBRARIES[key][0] == flags:
+		return AVR_LIBRARIES[key][1]
+
+	top = env.Dir('#')
+	objects = []
+	for src in sources:
+		path = src.get_path(top)
+		if os.path.isabs(path):
+			path = path.lstrip(os.sep)
+		path = os.path.splitext(path.replace('..', '__'))[0]
+		objects.extend(env.Object(vdir.Dir(name).File(path + env.subst('$OBJSUFFIX')), src))
+	library = env.StaticLibrary(target, objects)
+	AVR_LIBRARIES[key] = (flags, library)
+	return library
+
+# with AVR_CCACHE set to ccache (or a compatible wrapper), compilers are run through it.
+# The wrapper is excluded from the build signature, so turning it on or off does not
+# rebuild anything. MCU and clock are part of the compiler command line and therefore of
+# the ccache key. AVR_CCACHE_DIR sets CCACHE_DIR, the top directory is used as
+# CCACHE_BASEDIR so that checkouts in different places share hits.
+#
+# ccache counts hits and misses per cache directory; with AVR_CCACHE_STATS set, the change
+# of these counters during the build is printed at exit. Builds running in parallel on the
+# same cache directory are counted as well
+CCACHE_COUNTERS = globals().get('CCACHE_COUNTERS', {})
+
+def ccache_counters(ccache, environ):
+	"""Returns the hits and misses recorded by ccache, or None if ccache cannot report them
+	(--print-stats needs ccache 3.7)."""
+	try:
+		proc = subprocess.Popen([ccache, '--print-stats'], env = environ,
+		                        stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+		output = proc.communicate()[0].decode('utf8', 'replace')
+	except OSError:
+		return None
+	if proc.returncode:
+		return None
+
+	counters = {}
+	for line in output.splitlines():
+		key, _, value = line.partition('\t')
+		if value.strip().isdigit():
+			counters[key] = int(value)
+	hits = counters.get('direct_cache_hit', 0) + counters.get('preprocessed_cache_hit', 0)
+	return hits, counters.get('cache_miss', 0)
+
+def ccache_build_counts(key):
+	ccache, environ, start = CCACHE_COUNTERS[key]
+	end = ccache_counters(ccache, environ)
+	if not start or not end:
+		return None
+	return end[0] - start[0], end[1] - start[1]
+
+def cache_stats():
+	"""Hits and misses of ccache during this build, for the buildstats tool."""
+	stats = {}
+	for key in CCACHE_COUNTERS:
+		counts = ccache_build_counts(key)
+		if counts:
+			stats['avr ccache %s' % (key[1] or 'default')] = {'hits': counts[0], 'misses': counts[1]}
+	return stats
+
+def report_ccache(key):
+	counts = ccache_build_counts(key)
+	if not counts:
+		print 'ccache: hit rate not available'
+		return
+	hits, misses = counts
+	rate = 100.0 * hits / (hits + misses) if hits + misses else 0.0
+	print 'ccache: %d hits, %d misses (%.0f%% hit rate)' % (hits, misses, rate)
+
+def setup_ccache(env):
+	env['ENV']['CCACHE_BASEDIR'] = env.Dir('#').get_abspath()
+	if env['AVR_CCACHE_DIR']:
+		env['ENV']['CCACHE_DIR'] = env.Dir(env['AVR_CCACHE_DIR']).get_abspath()
+
+	ccache = env.WhereIs(env['AVR_CCACHE']) or env['AVR_CCACHE']
+	key = (ccache, env['ENV'].get('CCACHE_DIR'))
+	if key not in CCACHE_COUNTERS:
+		environ = dict((str(k), str(v)) for k, v in env['ENV'].items())
+		CCACHE_COUNTERS[key] = (ccache, environ, ccache_counters(ccache, environ))
+		if env['AVR_CCACHE_STATS']:
+			atexit.register(report_ccache, key)
+
+# AVRSize writes a JSON report of the flash and ram used by an elf file: totals and
+# sections from avr-size, symbols from avr-nm and the objects linked in (sizes before
+# --gc-sections) from avr-size on the link inputs. Against the report in
+# AVR_SIZE_BASELINE, the growth of totals, symbols and objects is listed. The build fails
+# if flash or ram exceed AVR_FLASH_BUDGET or AVR_RAM_BUDGET, which default to the size of
+# the AVR_MMCU and can be lowered to keep room for a bootloader or the stack.
+# To update the baseline, copy a report over it
+FLASH_SECTIONS = ('.text', '.data')
+RAM_SECTIONS = ('.data', '.bss', '.noinit')
+
+def run_binutil(env, tool, args):
+	environ = dict((str(k), str(v)) for k, v in env['ENV'].items())
+	cmd = [env.subst(tool)] + args
+	proc = subprocess.Popen(cmd, env = environ, stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+	output, errors = proc.communicate()
+	if proc.returncode:
+		raise BuildError(errstr = '%s failed: %s' % (' '.join(cmd), errors.decode('utf8', 'replace').strip()))
+	return output.decode('utf8', 'replace')
+
+def elf_sections(env, elf):
+	sections = {}
+	for line in run_binutil(env, '$AVR_SIZE_TOOL', ['-A', elf]).splitlines():
+		fields = line.split()
+		if len(fields) == 3 and fields[0].startswith('.') and fields[1].isdigit():
+			sections[fields[0]] = int(fields[1])
+	return sections
+
+def elf_symbols(env, elf):
+	symbols = {}
+	for line in run_binutil(env, '$AVR_NM', ['-S', '--size-sort', elf]).splitlines():
+		fields = line.split(None, 3)
+		if len(fields) == 4:
+			symbols[fields[3]] = {'size': int(fields[1], 16), 'type': fields[2]}
+	return symbols
+
+def object_sizes(env, objects):
+	sizes = {}
+	if not objects:
+		return sizes
+	output = run_binutil(env, '$AVR_SIZE_TOOL', ['-B'] + objects)
+	for line in output.splitlines()[1:]:
+		fields = line.split(None, 5)
+		if len(fields) == 6 and fields[0].isdigit():
+			sizes[fields[5]] = {'text': int(fields[0]), 'data': int(fields[1]), 'bss': int(fields[2])}
+	return sizes
+
+def size_growth(current, baseline, size):
+	growth = {}
+	for name in set(current) | set(baseline):
+		delta = (size(current[name]) if name in current else 0) - (size(baseline[name]) if name in baseline else 0)
+		if delta:
+			growth[name] = delta
+	return growth
+
+def avr_size(target, source, env):
+	elf = source[0]
+	inputs = [str(s) for s in elf.sources if os.path.splitext(str(s))[1] in ('.o', '.a')]
+	sections = elf_sections(env, str(elf))
+	report = {
+		'elf': str(elf),
+		'mcu': env['AVR_MMCU'],
+		'flash': sum(sections.get(name, 0) for name in FLASH_SECTIONS),
+		'ram': sum(sections.get(name, 0) for name in RAM_SECTIONS),
+		'budget': {'flash': env['AVR_FLASH_BUDGET'], 'ram': env['AVR_RAM_BUDGET']},
+		'sections': sections,
+		'symbols': elf_symbols(env, str(elf)),
+		'objects': object_sizes(env, inputs),
+	}
+
+	baseline = env.subst('$AVR_SIZE_BASELINE')
+	if baseline and os.path.exists(env.File(baseline).abspath):
+		with open(env.File(baseline).abspath) as f:
+			old = json.load(f)
+		report['growth'] = {
+			'flash': report['flash'] - old['flash'],
+			'ram': report['ram'] - old['ram'],
+			'symbols': size_growth(report['symbols'], old['symbols'], lambda s: s['size']),
+			'objects': size_growth(report['objects'], old['objects'], lambda o: o['text'] + o['data']),
+		}
+
+	with open(str(target[0]), 'w') as f:
+		json.dump(report, f, indent = 1, sort_keys = True)
+
+	summary = []
+	for region in ('flash', 'ram'):
+		line = '%s %d' % (region, report[region])
+		if report['budget'][region]:
+			line += '/%d bytes (%.1f%%)' % (report['budget'][region], 100.0 * report[region] / report['budget'][region])
+		else:
+			line += ' bytes'
+		if 'growth' in report:
+			line += ' %+d' % report['growth'][region]
+		summary.append(line)
+	print '%s: %s' % (elf, ', '.join(summary))
+	if 'growth' in report:
+		grown = sorted(report['growth']['symbols'].items(), key = lambda item: -item[1])
+		for name, delta in grown[:env['AVR_SIZE_SHOW_GROWTH']]:
+			if delta > 0:
+				print '  %+6d %s' % (delta, name)
+
+	exceeded = ['%s uses %d of %d bytes' % (region, report[region], report['budget'][region])
+	            for region in ('flash', 'ram')
+	            if report['budget'][region] and report[region] > report['budget'][region]]
+	if exceeded:
+		raise BuildError(errstr = '%s exceeds its budget for %s: %s' % (elf, env['AVR_MMCU'], ', '.join(exceeded)))
+
+def avr_size_emitter(target, source, env):
+	baseline = env.subst('$AVR_SIZE_BASELINE')
+	if baseline and env.File(baseline).exists():
+		env.Depends(target, env.File(baseline))
+	return target, source
+
 def generate(env):
 	bld = Builder(action = 'avr-objcopy -O ihex -R .eeprom $SOURCE $TARGET',
 					 suffix = '.hex',
 					 src_suffix = '.elf')
 	env.Append(BUILDERS = {'AVRHex': bld})
+	size_action = Action(avr_size, 'Sizing $SOURCE', varlist = ['AVR_MMCU', 'AVR_FLASH_BUDGET', 'AVR_RAM_BUDGET', 'AVR_SIZE_BASELINE'])
+	env.Append(BUILDERS = {'AVRSize': Builder(action = size_action,
+	                                          suffix = '.size.json',
+	                                          src_suffix = '.elf',
+	                                          emitter = avr_size_emitter)})
 
 	archflags = Split('-mmcu=$AVR_MMCU -DF_CPU=$AVR_F_CPU' % env)
-	env.Replace(CC = 'avr-gcc',
-	            CXX = 'avr-g++',
+	env.Replace(CC = '$( $AVR_CCACHE $) avr-gcc',
+	            CXX = '$( $AVR_CCACHE $) avr-g++',
 	            AR = 'avr-ar',
 	            RANLIB = 'avr-ranlib')
 	env.SetDefault(AVR_MMCU = 'atmega328p')
+	env.SetDefault(AVR_VARIANT_ROOT = '#build/avr')
+	env.SetDefault(AVR_CCACHE = None)
+	env.SetDefault(AVR_CCACHE_DIR = None)
+	env.SetDefault(AVR_CCACHE_STATS = True)
+	env.AddMethod(avr_library, 'AVRLibrary')
+	if env['AVR_CCACHE']:
+		setup_ccache(env)
 
 	# freq table fillin
 	if env['AVR_MMCU'] not in cpu_freq_table and not 'F_CPU' in env:
 		print 'Warning: Unknown AVR_MMCU "%s" and AVR_F_CPU not set.' % env['AVR_MMCU']
 	env.SetDefault(AVR_F_CPU = cpu_freq_table.get(env['AVR_MMCU'], ''))
+	flash, ram = memory_table.get(env['AVR_MMCU'], (None, None))
+	env.SetDefault(AVR_FLASH_BUDGET = flash,
+	               AVR_RAM_BUDGET = ram,
+	               AVR_SIZE_BASELINE = None,
+	               AVR_SIZE_SHOW_GROWTH = 10,
+	               AVR_SIZE_TOOL = 'avr-size',
+	               AVR_NM = 'avr-nm')
 
 	env.Append(CFLAGS = archflags,
 			   CXXFLAGS = archflags,
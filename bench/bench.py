@@ -0,0 +1,466 @@
+#!/usr/bin/env python
+# coding=utf8
+
+"""Benchmarks for the tools in this repository.
+
+Every benchmark generates a synthetic project in a temporary directory and
+builds it with SCons, using stub compilers so that no network access or
+external tools are needed. Timings of actions and scanners are taken from the
+buildstats tool, wall times of whole SCons runs (no-op builds in particular)
+are measured around the process.
+
+    python bench/bench.py                      # run all benchmarks
+    python bench/bench.py less coffee          # run some of them
+    python bench/bench.py --json results.json  # keep the results
+    python bench/bench.py --baseline results.json
+
+With --baseline, results more than --threshold worse than the baseline are
+reported and the exit status is 1. --scale grows or shrinks all projects,
+--scons names the SCons command, which may run on python 2 or 3.
+"""
+
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+import random
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# stub compilers, run by the python running the benchmarks. They copy their
+# input, which is enough for SCons to build and for the scanners to work
+STUBS = {
+    'lessc': """
+if sys.argv[1:] == ['--version']:
+    print('lessc stub 1.0')
+    sys.exit(0)
+source, target = [arg.strip('"') for arg in sys.argv[-2:]]
+shutil.copyfile(source, target)
+""",
+    'coffee': """
+if sys.argv[1:] == ['--version']:
+    print('coffee stub 1.0')
+    sys.exit(0)
+for source in sys.argv[1:]:
+    if not source.startswith('-'):
+        sys.stdout.write(open(source).read())
+""",
+    'rst2html': """
+shutil.copyfile(sys.argv[-2], sys.argv[-1])
+""",
+    # a page costs PAGE_TIME seconds and PAGE_SIZE bytes
+    'convert': """
+time.sleep(float(os.environ.get('PAGE_TIME', '0.005')))
+with open(sys.argv[-1], 'wb') as out:
+    out.write(b'%PDF' + b'.' * int(os.environ.get('PAGE_SIZE', '20000')))
+""",
+    # merging costs time in proportion to the amount of data
+    'pdftk': """
+inputs = sys.argv[1:sys.argv.index('cat')]
+with open(sys.argv[-1], 'wb') as out:
+    for path in inputs:
+        with open(path, 'rb') as page:
+            data = page.read()
+        time.sleep(len(data) / 200e6)
+        out.write(data)
+""",
+}
+
+STUB_HEADER = '#!%s\nimport os, shutil, sys, time\n' % sys.executable
+
+SCONSTRUCT = """
+import os
+env = Environment(tools=%(tools)r, toolpath=[%(repo)r],
+                  ENV={'PATH': os.path.abspath('bin') + os.pathsep +
+                               os.environ['PATH']})
+for key in ('PAGE_TIME', 'PAGE_SIZE'):
+    if key in os.environ:
+        env['ENV'][key] = os.environ[key]
+%(body)s
+"""
+
+WORDS = ('build scanner target source archive cache deflate block import '
+         'require module chapter figure include image page merge tree node '
+         'signature action compile worker thread batch output').split()
+
+
+class BuildFailed(Exception):
+    pass
+
+
+class Project(object):
+    """A synthetic project, built by running SCons in its directory."""
+
+    def __init__(self, root, scons, jobs):
+        self.root = root
+        self.scons = scons
+        self.jobs = jobs
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def write(self, name, contents):
+        path = self.path(name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb' if isinstance(contents, bytes) else 'w') as out:
+            out.write(contents)
+        return name
+
+    def stub(self, *names):
+        for name in names:
+            path = self.write(os.path.join('bin', name),
+                              STUB_HEADER + STUBS[name])
+            os.chmod(self.path(path), 0o755)
+
+    def sconstruct(self, tools, body):
+        self.write('SConstruct', SCONSTRUCT % {
+            'tools': ['buildstats'] + tools, 'repo': REPO, 'body': body})
+
+    def build(self, *args, **environ):
+        """Runs SCons, returning its wall time and the buildstats report."""
+        env = dict(os.environ)
+        env.update((key, str(value)) for key, value in environ.items())
+        command = self.scons + ['-Q', '-j%d' % self.jobs] + list(args)
+        start = time.time()
+        proc = subprocess.Popen(command, cwd=self.root, env=env,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        output = proc.communicate()[0]
+        wall = time.time() - start
+        if proc.returncode:
+            raise BuildFailed(output.decode('utf8', 'replace'))
+        with open(self.path('buildstats.json')) as report:
+            return wall, json.load(report)
+
+    def touch(self, name, text='\n'):
+        with open(self.path(name), 'a') as out:
+            out.write(text)
+
+
+class Results(object):
+    def __init__(self):
+        self.values = collections.OrderedDict()
+
+    def add(self, benchmark, metric, value, unit, better='lower'):
+        self.values['%s.%s' % (benchmark, metric)] = {
+            'value': value, 'unit': unit, 'better': better}
+        print('%-40s %12.3f %s' % ('%s.%s' % (benchmark, metric), value, unit))
+
+    def regressions(self, baseline, threshold):
+        for name, result in self.values.items():
+            if name not in baseline:
+                continue
+            old, new = baseline[name]['value'], result['value']
+            if result['better'] == 'lower':
+                worse = new > old * (1 + threshold)
+            else:
+                worse = new < old * (1 - threshold)
+            if worse:
+                yield name, old, new, result['unit']
+
+
+def scanner_time(report, name):
+    return report['scanners'].get(name, {'time': 0.0})['time']
+
+
+def action_time(report, target):
+    return sum(action['wall'] for action in report['actions']
+               if target in action['targets'])
+
+
+def text(rng, size):
+    """Compressible text of about size bytes."""
+    line = []
+    lines = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        line.append(word)
+        length += len(word) + 1
+        if len(line) == 12:
+            lines.append(' '.join(line))
+            line = []
+    lines.append(' '.join(line))
+    return '\n'.join(lines)
+
+
+BENCHMARKS = collections.OrderedDict()
+
+
+def benchmark(name):
+    def register(function):
+        BENCHMARKS[name] = function
+        return function
+    return register
+
+
+def noop_builds(project, results, name, scanner, *args):
+    """Measures no-op builds, which rescan all sources."""
+    wall, report = project.build(*args)
+    scan = scanner_time(report, scanner)
+    calls = report['scanners'].get(scanner, {'calls': 0})['calls']
+    results.add(name, 'noop_build', wall, 's')
+    results.add(name, 'scan_time', scan, 's')
+    if scan:
+        results.add(name, 'scan_rate', calls / scan, 'files/s', 'higher')
+    return report
+
+
+@benchmark('less')
+def bench_less(project, results, scale):
+    """A deep LESS import graph: every file imports three files of the next
+    level, the files of the first level are compiled."""
+    levels, width = 8, max(2, int(60 * scale))
+    for level in range(levels):
+        for i in range(width):
+            imports = [] if level == levels - 1 else [
+                '@import "l%d/f%d.less";' % (level + 1, (3 * i + k) % width)
+                for k in range(3)]
+            project.write('less/l%d/f%d.less' % (level, i), '\n'.join(
+                imports + ['.c%d-%d { color: red; }' % (level, i)]))
+    project.stub('lessc')
+    project.sconstruct(['web'], """
+env['LESS_INCLUDE_PATH'] = ['less']
+env['WEB_SCAN_CACHE'] = ARGUMENTS.get('scan_cache') or None
+for i in range(%d):
+    env.Less('css/f%%d.css' %% i, 'less/l0/f%%d.less' %% i)
+""" % width)
+
+    wall, report = project.build()
+    results.add('less', 'full_build', wall, 's')
+    noop_builds(project, results, 'less', 'less_scan')
+    project.build('scan_cache=.scan-cache')
+    noop_builds(project, results, 'less.scan_cache', 'less_scan',
+                'scan_cache=.scan-cache')
+
+
+@benchmark('coffee')
+def bench_coffee(project, results, scale):
+    """Thousands of require()-linked scripts next to large vendored files,
+    one of them minified, scanned with and without COFFEE_SKIP_MINIFIED."""
+    rng = random.Random(1)
+    count = max(10, int(2000 * scale))
+    for i in range(count):
+        requires = ["var m%d = require('./m%d');" % (k, k)
+                    for k in rng.sample(range(count), 3)]
+        project.write('js/m%d.js' % i, '\n'.join(
+            ['// require("./not-a-dependency")'] + requires +
+            ['var s = "require(\'./in-a-string\')";', text(rng, 2000)]))
+    for i in range(count // 4):
+        project.write('coffee/c%d.coffee' % i, '\n'.join(
+            ["m = require '../js/m%d'" % (i % count), text(rng, 1000)]))
+
+    vendored = int(2e6 * scale)
+    project.write('vendor/big.js', text(rng, vendored))
+    project.write('vendor/bundle.min.js', text(rng, vendored)
+                  .replace('\n', ';'))
+    project.write('vendor/bundle.js', text(rng, vendored).replace('\n', ';'))
+    project.stub('coffee')
+    project.sconstruct(['web'], """
+env['COFFEE_SKIP_MINIFIED'] = bool(int(ARGUMENTS.get('skip_minified', 1)))
+
+def concat(target, source, env):
+    with open(str(target[0]), 'w') as out:
+        for src in source:
+            out.write(src.get_text_contents())
+
+env.Command('all.js', Glob('js/*.js') + Glob('vendor/*.js'), concat)
+for source in Glob('coffee/*.coffee'):
+    env.Coffee(source)
+""")
+
+    wall, report = project.build()
+    results.add('coffee', 'full_build', wall, 's')
+    noop_builds(project, results, 'coffee', 'coffee_scan')
+    noop_builds(project, results, 'coffee.scan_minified', 'coffee_scan',
+                'skip_minified=0')
+
+
+@benchmark('rst')
+def bench_rst(project, results, scale):
+    """A manual of many documents including shared chapters, which include
+    sections with images."""
+    count = max(5, int(300 * scale))
+    rng = random.Random(2)
+    for i in range(count // 2):
+        project.write('parts/section%d.rst' % i, '\n\n'.join(
+            ['.. image:: img/s%d.png' % i, text(rng, 1500)]))
+        project.write('parts/img/s%d.png' % i, 'png')
+    for i in range(count // 3):
+        project.write('parts/chapter%d.rst' % i, '\n\n'.join(
+            ['.. include:: section%d.rst' % k
+             for k in rng.sample(range(count // 2), 4)] + [text(rng, 1000)]))
+    for i in range(count):
+        project.write('docs/d%d.rst' % i, '\n\n'.join(
+            ['Document %d\n%s' % (i, '=' * 20)] +
+            ['.. include:: ../parts/chapter%d.rst' % k
+             for k in rng.sample(range(count // 3), 3)]))
+    project.stub('rst2html')
+    project.sconstruct(['documents'], """
+env['DOC_SCAN_CACHE'] = ARGUMENTS.get('scan_cache') or None
+for source in Glob('docs/*.rst'):
+    env.RST2HTML(source)
+""")
+
+    wall, report = project.build()
+    results.add('rst', 'full_build', wall, 's')
+    noop_builds(project, results, 'rst', 'rst_scan')
+    project.build('scan_cache=.scan-cache')
+    noop_builds(project, results, 'rst.scan_cache', 'rst_scan',
+                'scan_cache=.scan-cache')
+
+
+ARCHIVE_FORMATS = ['zip', 'tar', 'tar.gz', 'tar.bz2', 'tar.xz', 'tar.zst',
+                   'tar.lz4']
+
+
+@benchmark('archive')
+def bench_archive(project, results, scale):
+    """Throughput and size of every archive format, on one thread and on all
+    CPUs. Formats whose compression module is missing are skipped."""
+    rng = random.Random(3)
+    total = int(64 * 1024 * 1024 * scale)
+    size = 0
+    index = 0
+    while size < total:
+        length = min(int(rng.expovariate(1.0 / (256 * 1024))) + 1024,
+                     4 * 1024 * 1024)
+        project.write('data/%d/f%d.txt' % (index % 16, index),
+                      text(rng, length))
+        size += length
+        index += 1
+    project.sconstruct(['archive'], """
+env['ARCHIVE_VERBOSE'] = False
+env['ARCHIVE_JOBS'] = int(ARGUMENTS.get('jobs', 1))
+sources = sorted(Glob('data/*/*.txt'))
+for suffix in %r:
+    env.Archive('out.' + suffix, sources)
+""" % ARCHIVE_FORMATS)
+
+    megabytes = size / 1024.0 / 1024.0
+    for jobs in sorted(set([1, multiprocessing.cpu_count()])):
+        for suffix in ARCHIVE_FORMATS:
+            target = 'out.' + suffix
+            try:
+                wall, report = project.build(target, 'jobs=%d' % jobs)
+            except BuildFailed as e:
+                print('archive.%s: skipped (%s)' % (
+                    suffix, e.args[0].strip().splitlines()[-1]))
+                continue
+            name = 'archive.%s.jobs%d' % (suffix, jobs)
+            seconds = action_time(report, target)
+            results.add(name, 'throughput', megabytes / seconds, 'MB/s',
+                        'higher')
+            results.add(name, 'ratio',
+                        os.path.getsize(project.path(target)) / float(size),
+                        'of input')
+            os.remove(project.path(target))
+
+
+@benchmark('pdf')
+def bench_pdf(project, results, scale):
+    """Synthetic page sets: converting scans to one document on one process
+    and on all CPUs, merging flat and in a tree, and remerging after a page
+    changed with the incremental merge tree."""
+    pages = max(8, int(200 * scale))
+    for i in range(pages):
+        project.write('scans/p%04d.jpg' % i, 'jpg')
+        project.write('pages/p%04d.pdf' % i, '%PDF' + '.' * 200000)
+    project.stub('convert', 'pdftk')
+    project.sconstruct(['documents'], """
+env['PDF_JOBS'] = int(ARGUMENTS.get('pdf_jobs', 0))
+env['PDF_PIPELINE'] = bool(int(ARGUMENTS.get('pipeline', 0)))
+env['PDF_MERGE_INCREMENTAL'] = bool(int(ARGUMENTS.get('incremental', 0)))
+env['PDF_MERGE_FANOUT'] = int(ARGUMENTS.get('fanout', 16))
+env.ImgToPDF('scans.pdf', sorted(Glob('scans/*.jpg')))
+env.PDFMerge('merged.pdf', sorted(Glob('pages/*.pdf')))
+""")
+
+    for jobs in sorted(set([1, multiprocessing.cpu_count()])):
+        wall, report = project.build('scans.pdf', 'pdf_jobs=%d' % jobs)
+        results.add('pdf.img_to_pdf.jobs%d' % jobs, 'build',
+                    action_time(report, 'scans.pdf'), 's')
+        os.remove(project.path('scans.pdf'))
+
+    for name, args in (('flat', []), ('pipeline', ['pipeline=1'])):
+        wall, report = project.build('merged.pdf', *args)
+        results.add('pdf.merge.%s' % name, 'build',
+                    action_time(report, 'merged.pdf'), 's')
+        os.remove(project.path('merged.pdf'))
+
+    changed = 'pages/p%04d.pdf' % (pages // 2)
+    for name, args in (('flat', []),
+                       ('incremental', ['incremental=1', 'fanout=4'])):
+        project.build('merged.pdf', *args)
+        project.touch(changed, '.')
+        wall, report = project.build('merged.pdf', *args)
+        results.add('pdf.remerge.%s' % name, 'build',
+                    sum(action['wall'] for action in report['actions']), 's')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK',
+                        help='one of %s' % ', '.join(BENCHMARKS))
+    parser.add_argument('--scons', default='scons',
+                        help='SCons command (default: %(default)s)')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='SCons jobs (default: %(default)s)')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='size of the generated projects')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare to results of a '
+                        'previous run written with --json')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='relative change counted as regression')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the generated projects')
+    args = parser.parse_args()
+
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmarks: %s' % ', '.join(sorted(unknown)))
+
+    results = Results()
+    root = tempfile.mkdtemp(prefix='scons-tools-bench-')
+    try:
+        for name in args.benchmarks or BENCHMARKS:
+            project = Project(os.path.join(root, name),
+                              shlex.split(args.scons), args.jobs)
+            os.makedirs(project.root)
+            try:
+                BENCHMARKS[name](project, results, args.scale)
+            except BuildFailed as e:
+                print('%s: build failed\n%s' % (name, e))
+                return 2
+    finally:
+        if args.keep:
+            print('projects kept in %s' % root)
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(results.values, out, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = list(results.regressions(baseline, args.threshold))
+        for name, old, new, unit in regressions:
+            print('REGRESSION %s: %.3f -> %.3f %s' % (name, old, new, unit))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# coding=utf8
+
+# Records how long the build spends where. Add 'buildstats' to the tools of
+# an environment to enable it; when SCons exits, BUILDSTATS_REPORT receives a
+# JSON report and BUILDSTATS_TRACE a trace viewable in chrome://tracing or
+# Perfetto. The recorder is process wide, so the actions of all environments
+# are timed, but only children spawned through environments that loaded this
+# tool are measured.
+#
+# For every executed action, the report lists its targets, wall time, CPU
+# time of the SCons thread running it (python 3.3+), and CPU time and peak
+# resident set size of the processes it spawned. Scanners are timed per
+# scanner, and tools keeping caches report their hit rates through a
+# cache_stats() function returning {name: {'hits': n, 'misses': n}}.
+
+import atexit
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import SCons.Executor
+import SCons.Scanner
+
+thread_time = getattr(time, 'thread_time', None)
+
+
+class BuildStats(object):
+    def __init__(self):
+        self.start = time.time()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.actions = []
+        self.scans = []
+        self.scanners = {}
+        self.threads = {}
+        self.report_path = None
+        self.trace_path = None
+        self.installed = False
+
+    def thread_index(self):
+        ident = threading.current_thread().ident
+        with self.lock:
+            return self.threads.setdefault(ident, len(self.threads))
+
+    def add_action(self, record):
+        record['thread'] = self.thread_index()
+        with self.lock:
+            self.actions.append(record)
+
+    def add_scan(self, name, node, start, duration):
+        tid = self.thread_index()
+        with self.lock:
+            totals = self.scanners.setdefault(name, {'calls': 0, 'time': 0.0})
+            totals['calls'] += 1
+            totals['time'] += duration
+            self.scans.append((name, node, start, duration, tid))
+
+    def cache_stats(self):
+        stats = {}
+        for name, module in list(sys.modules.items()):
+            cache_stats = getattr(module, 'cache_stats', None)
+            if (callable(cache_stats) and hasattr(module, 'generate') and
+                    hasattr(module, 'exists')):
+                for cache, counts in cache_stats().items():
+                    lookups = counts['hits'] + counts['misses']
+                    stats[cache] = dict(counts, hit_rate=(
+                        float(counts['hits']) / lookups if lookups else None))
+        return stats
+
+    def report(self):
+        actions = sorted(self.actions, key=lambda record: record['start'])
+        return {'wall_time': time.time() - self.start,
+                'actions': actions,
+                'scanners': self.scanners,
+                'caches': self.cache_stats()}
+
+    def trace(self):
+        pid = os.getpid()
+        events = []
+        for record in self.actions:
+            events.append({'name': record['targets'][0]
+                           if record['targets'] else '<no target>',
+                           'cat': 'action', 'ph': 'X', 'pid': pid,
+                           'tid': record['thread'],
+                           'ts': record['start'] * 1e6,
+                           'dur': record['wall'] * 1e6,
+                           'args': dict((key, record[key]) for key in
+                                        ('targets', 'cpu', 'child_cpu',
+                                         'max_rss_kb', 'children'))})
+        for name, node, start, duration, tid in self.scans:
+            events.append({'name': name, 'cat': 'scan', 'ph': 'X',
+                           'pid': pid, 'tid': tid, 'ts': start * 1e6,
+                           'dur': duration * 1e6, 'args': {'node': node}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save(self):
+        for path, data in ((self.report_path, self.report),
+                           (self.trace_path, self.trace)):
+            if not path:
+                continue
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w') as out:
+                json.dump(data(), out, indent=1, sort_keys=True)
+            os.rename(tmp_path, path)
+
+
+# SCons on python 2 executes this module again for every environment loading
+# the tool; the recorder and the unpatched methods are kept from the first run
+STATS = globals().get('STATS') or BuildStats()
+
+original_execute = globals().get('original_execute',
+                                 SCons.Executor.Executor.__call__)
+original_scan = globals().get('original_scan', SCons.Scanner.Base.__call__)
+
+
+def timed_execute(self, target, **kw):
+    record = {'targets': [str(t) for t in self.get_all_targets()],
+              'start': time.time() - STATS.start,
+              'children': 0,
+              'child_cpu': 0.0,
+              'max_rss_kb': None}
+    STATS.local.action = record
+    cpu = thread_time() if thread_time else None
+    try:
+        return original_execute(self, target, **kw)
+    finally:
+        STATS.local.action = None
+        record['wall'] = time.time() - STATS.start - record['start']
+        record['cpu'] = thread_time() - cpu if thread_time else None
+        STATS.add_action(record)
+
+
+def timed_scan(self, node, env, path=()):
+    # selectors call the scanner they select, only the outer call is timed
+    if getattr(STATS.local, 'scanning', False):
+        return original_scan(self, node, env, path)
+
+    STATS.local.scanning = True
+    start = time.time()
+    try:
+        return original_scan(self, node, env, path)
+    finally:
+        STATS.local.scanning = False
+        name = self.name if self.name != 'NONE' else \
+            getattr(self.function, '__name__', repr(self))
+        STATS.add_scan(name, str(node), start - STATS.start,
+                       time.time() - start)
+
+
+def measured_spawn(spawn):
+    """Wraps the posix spawn function of SCons, collecting resource usage of
+    the child with wait4."""
+    def spawn_child(sh, escape, cmd, args, env):
+        record = getattr(STATS.local, 'action', None)
+        if record is None:
+            return spawn(sh, escape, cmd, args, env)
+
+        proc = subprocess.Popen([sh, '-c', ' '.join(args)], env=env,
+                                close_fds=True)
+        pid, status, usage = os.wait4(proc.pid, 0)
+        if os.WIFSIGNALED(status):
+            proc.returncode = -os.WTERMSIG(status)
+        else:
+            proc.returncode = os.WEXITSTATUS(status)
+
+        # ru_maxrss is in bytes on OS X, in kilobytes everywhere else
+        max_rss = usage.ru_maxrss
+        if sys.platform == 'darwin':
+            max_rss //= 1024
+        record['children'] += 1
+        record['child_cpu'] += usage.ru_utime + usage.ru_stime
+        record['max_rss_kb'] = max(record['max_rss_kb'] or 0, max_rss)
+        return proc.returncode
+    spawn_child.measured = True
+    return spawn_child
+
+
+def generate(env):
+    env.SetDefault(BUILDSTATS_REPORT='buildstats.json')
+    env.SetDefault(BUILDSTATS_TRACE='buildstats.trace.json')
+
+    if not STATS.installed:
+        STATS.installed = True
+        SCons.Executor.Executor.__call__ = timed_execute
+        SCons.Scanner.Base.__call__ = timed_scan
+        for var, attr in (('BUILDSTATS_REPORT', 'report_path'),
+                          ('BUILDSTATS_TRACE', 'trace_path')):
+            if env[var]:
+                setattr(STATS, attr, env.File(env[var]).get_abspath())
+        atexit.register(STATS.save)
+
+    # environments cloned from one loading the tool carry a measured SPAWN
+    spawn = env.get('SPAWN')
+    if (hasattr(os, 'wait4') and not getattr(spawn, 'measured', False) and
+            getattr(spawn, '__module__', None) == 'SCons.Platform.posix'):
+        env['SPAWN'] = measured_spawn(spawn)
+
+
+def exists(env):
+    return True
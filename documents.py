@@ -1,43 +1,665 @@
 #!/usr/bin/env python
 # coding=utf8
 
-from SCons.Script import Builder
+import atexit
+import collections
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
+
+from SCons.Errors import BuildError
+from SCons.Script import Action, Builder, Scanner
 
 # 150 dpi, a4 (210mm x 297mm)
 a4_dim_px = (1240, 1754)
 
 
+def img_to_pdf_args(source, target):
+    return ['convert', source, '-units', 'PixelsPerInch', '-density', '150',
+            '-quality', '80', '-resize', '%dx%d' % a4_dim_px, target]
+
+
+class OutputCache(object):
+    """Content-addressed store of build outputs, keyed by dependencies, command
+    line and tool version. Uses the same layout as the cache in web.py, so
+    both tools can share OUTPUT_CACHE_DIR."""
+
+    def __init__(self, path, max_size, shared=None):
+        self.path = path
+        self.max_size = max_size
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        atexit.register(self.evict)
+
+    def entry_path(self, root, key):
+        return os.path.join(root, key[:2], key)
+
+    def get(self, key, target):
+        for root in (self.path, self.shared):
+            entry = self.entry_path(root, key) if root else None
+            if not entry or not os.path.isdir(entry):
+                continue
+            try:
+                for index, tgt in enumerate(target):
+                    shutil.copyfile(os.path.join(entry, str(index)),
+                                    tgt.get_abspath())
+                if root == self.path:
+                    os.utime(entry, None)
+            except (IOError, OSError):
+                continue
+            self.hits += 1
+            return True
+
+        self.misses += 1
+        return False
+
+    def put(self, key, target):
+        entry = self.entry_path(self.path, key)
+        tmp_entry = '%s.tmp-%d-%d' % (entry, os.getpid(),
+                                      threading.current_thread().ident)
+        try:
+            os.makedirs(tmp_entry)
+            for index, tgt in enumerate(target):
+                shutil.copyfile(tgt.get_abspath(),
+                                os.path.join(tmp_entry, str(index)))
+            os.rename(tmp_entry, entry)
+        except (IOError, OSError):
+            # stored by a parallel build already, or not writable
+            shutil.rmtree(tmp_entry, True)
+            return
+        self.dirty = True
+
+    def evict(self):
+        if not self.dirty:
+            return
+
+        entries = []
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            if dirpath == self.path:
+                continue
+            for dirname in dirnames:
+                entry = os.path.join(dirpath, dirname)
+                try:
+                    size = sum(os.path.getsize(os.path.join(entry, name))
+                               for name in os.listdir(entry))
+                    entries.append((os.path.getmtime(entry), size, entry))
+                except OSError:
+                    continue
+                total += size
+            del dirnames[:]
+
+        entries.sort()
+        for mtime, size, entry in entries:
+            if total <= self.max_size:
+                break
+            shutil.rmtree(entry, True)
+            total -= size
+        self.dirty = False
+
+
+# registries below survive SCons executing the module again for every
+# environment loading the tool, as it does on python 2
+OUTPUT_CACHES = globals().get('OUTPUT_CACHES', {})
+TOOL_VERSIONS = globals().get('TOOL_VERSIONS', {})
+
+
+def get_output_cache(env):
+    path = env.Dir(env['OUTPUT_CACHE_DIR']).get_abspath()
+    if path not in OUTPUT_CACHES:
+        shared = env['OUTPUT_CACHE_SHARED']
+        OUTPUT_CACHES[path] = OutputCache(
+            path, int(env['OUTPUT_CACHE_SIZE']),
+            env.Dir(shared).get_abspath() if shared else None)
+    return OUTPUT_CACHES[path]
+
+
+def tool_version(env, version_command):
+    """Returns the output of version_command, which is run once per build."""
+    if version_command not in TOOL_VERSIONS:
+        environ = dict((str(k), str(v)) for k, v in env['ENV'].items())
+        try:
+            proc = subprocess.Popen(version_command, shell=True,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT, env=environ)
+            TOOL_VERSIONS[version_command] = proc.communicate()[0]
+        except OSError:
+            TOOL_VERSIONS[version_command] = b''
+    return TOOL_VERSIONS[version_command]
+
+
+def output_cache_key(env, target, source, command, version_command):
+    key = hashlib.sha1(tool_version(env, version_command))
+    key.update(env.subst(command, 2, target, source).encode('utf8'))
+    for child in target[0].children():
+        key.update(('\0%s\0%s' % (child, child.get_csig())).encode('utf8'))
+    return key.hexdigest()
+
+
+def output_cache_action(command, version_command):
+    """Returns an action running command, unless its targets are found in the
+    output cache. version_command prints the version of the tool."""
+    action = Action(command)
+
+    def build_cached(target, source, env):
+        cache = get_output_cache(env)
+        key = output_cache_key(env, target, source, command, version_command)
+        if cache.get(key, target):
+            return 0
+
+        status = action(target, source, env, show=False)
+        if not status:
+            cache.put(key, target)
+        return status
+
+    return Action(build_cached, strfunction=lambda target, source, env:
+                  env.subst(command, 0, target, source))
+
+
+def cached_command(command, version_command):
+    """Returns a generator running command through the output cache, if
+    OUTPUT_CACHE_DIR is set."""
+    def generator(source, target, env, for_signature):
+        if env['OUTPUT_CACHE_DIR'] and not for_signature:
+            return output_cache_action(command, version_command)
+        return command
+    return generator
+
+
+class ScanCache(object):
+    """Dependencies found in files, keyed by their content signature. Files
+    included by many documents are only scanned once per build and, if
+    DOC_SCAN_CACHE names a file, not again until they change."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.entries = {}
+        self.dirty = False
+
+        if path:
+            try:
+                with open(path) as cache_file:
+                    self.entries = json.load(cache_file)
+            except (IOError, ValueError):
+                pass
+            atexit.register(self.save)
+
+    def lookup(self, kind, node, scan):
+        key = '%s:%s' % (kind, node.get_csig())
+        if key in self.entries:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.entries[key] = scan(node.get_text_contents())
+            self.dirty = True
+        return self.entries[key]
+
+    def save(self):
+        if not self.dirty:
+            return
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as cache_file:
+            json.dump(self.entries, cache_file)
+        os.rename(tmp_path, self.path)
+        self.dirty = False
+
+
+SCAN_CACHES = globals().get('SCAN_CACHES', {})
+
+
+def get_scan_cache(env):
+    path = env['DOC_SCAN_CACHE']
+    if path:
+        path = env.File(path).get_abspath()
+    if path not in SCAN_CACHES:
+        SCAN_CACHES[path] = ScanCache(path)
+    return SCAN_CACHES[path]
+
+
+def cache_stats():
+    """Hits and misses of the caches used so far, for the buildstats tool."""
+    stats = {}
+    for path, cache in OUTPUT_CACHES.items():
+        stats['documents output cache %s' % path] = {'hits': cache.hits,
+                                                     'misses': cache.misses}
+    for path, cache in SCAN_CACHES.items():
+        stats['documents scan cache %s' % (path or '(memory)')] = {
+            'hits': cache.hits, 'misses': cache.misses}
+    return stats
+
+
+# directives naming another file, including substitution definitions like
+# ".. |logo| image:: logo.png". Paths in <> refer to the docutils standard
+# library
+RST_DIRECTIVE_RE = re.compile(
+    r'^[ \t]*\.\.[ \t]+(?:\|[^|]+\|[ \t]+)?'
+    r'(include|literalinclude|image|figure)::[ \t]*(\S.*?)[ \t]*$', re.M)
+RST_FILE_OPTION_RE = re.compile(r'^[ \t]+:file:[ \t]*(\S.*?)[ \t]*$', re.M)
+# http://, mailto:, data: and the like; a single letter is a windows drive
+URI_SCHEME_RE = re.compile(r'^[a-zA-Z][a-zA-Z0-9+.-]+:')
+
+
+def rst_references(contents):
+    references = [[kind, path]
+                  for kind, path in RST_DIRECTIVE_RE.findall(contents)]
+    references.extend(['file', path]
+                      for path in RST_FILE_OPTION_RE.findall(contents))
+    # absolute image paths are locations on the web server, not files
+    return [[kind, path] for kind, path in references
+            if not path.startswith('<') and not URI_SCHEME_RE.match(path) and
+            not (kind in ('image', 'figure') and path.startswith('/'))]
+
+
+def scan_references(node, env, kind, references):
+    """Yields the files referenced by node, following includes. references
+    returns [kind, path] pairs for the contents of a file, paths are relative
+    to the file containing them. References to files that neither exist nor
+    are built are left to the tool to report."""
+    cache = get_scan_cache(env)
+    seen = set([node])
+    pending = [node]
+    while pending:
+        current = pending.pop()
+        if not current.exists():
+            continue
+        for ref_kind, fn in cache.lookup(kind, current, references):
+            dep = current.dir.File(fn)
+            if dep in seen or not (dep.has_builder() or dep.exists()):
+                continue
+            seen.add(dep)
+            if ref_kind == 'include':
+                pending.append(dep)
+            yield dep
+
+
+def rst_scan(node, env, path):
+    return scan_references(node, env, 'rst', rst_references)
+
+
+# graphviz loads images and shapefiles named in attributes. Graphs run through
+# cpp first may also #include other files
+DOT_REFERENCE_RE = re.compile(
+    r'(?:\b(?:image|shapefile)\s*=\s*"([^"]+)"|^\s*#\s*include\s*"([^"]+)")',
+    re.M)
+
+
+def dot_references(contents):
+    return [['image', image] if image else ['include', include]
+            for image, include in DOT_REFERENCE_RE.findall(contents)]
+
+
+def dot_scan(node, env, path):
+    return scan_references(node, env, 'dot', dot_references)
+
+
+rst_scanner = Scanner(function=rst_scan, skeys=['.rst'])
+dot_scanner = Scanner(function=dot_scan, skeys=['.dot'])
+
+
+# with DOC_DOCUTILS set, RST2HTML and RST2Latex run docutils in resident
+# python processes instead of starting rst2html or rst2latex per document.
+# Workers import docutils once and keep the parsed settings of every flag
+# combination they have seen
+DOCUTILS_WORKER_SCRIPT = r"""
+import copy, json, sys
+import docutils.core
+
+stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+# nothing but responses may be written to stdout
+sys.stdout = sys.stderr
+settings = {}
+
+def get_settings(writer, args):
+    key = json.dumps([writer, args])
+    if key not in settings:
+        publisher = docutils.core.Publisher()
+        publisher.set_components('standalone', 'restructuredtext', writer)
+        publisher.process_command_line(args)
+        settings[key] = publisher.settings
+    return copy.deepcopy(settings[key])
+
+for line in iter(stdin.readline, b''):
+    job = json.loads(line.decode('utf8'))
+    try:
+        docutils.core.publish_file(
+            source_path=job['source'], destination_path=job['target'],
+            writer_name=job['writer'],
+            settings=get_settings(job['writer'], job['args']))
+        response = {}
+    except SystemExit as e:
+        response = {'error': 'docutils exited with status %s' % e.code}
+    except Exception as e:
+        response = {'error': '%s: %s' % (type(e).__name__, e)}
+    stdout.write(json.dumps(response).encode('utf8') + b'\n')
+    stdout.flush()
+"""
+
+
+class DocutilsError(Exception):
+    pass
+
+
+class DocutilsWorker(object):
+    """A python process publishing one document at a time."""
+
+    def __init__(self, python, environ):
+        self.process = subprocess.Popen(
+            [python, '-c', DOCUTILS_WORKER_SCRIPT],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=environ)
+
+    def run(self, job):
+        try:
+            self.process.stdin.write(json.dumps(job).encode('utf8') + b'\n')
+            self.process.stdin.flush()
+            line = self.process.stdout.readline()
+        except (IOError, OSError) as e:
+            raise DocutilsError(str(e))
+
+        if not line:
+            raise DocutilsError('worker exited with %s' % self.process.wait())
+
+        response = json.loads(line.decode('utf8'))
+        if 'error' in response:
+            raise DocutilsError(response['error'])
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        self.process.wait()
+
+
+class DocutilsPool(object):
+    """Up to size workers shared by all parallel actions. Once a worker fails
+    to start or dies, no further workers are started."""
+
+    def __init__(self, python, environ, size):
+        self.python = python
+        self.environ = environ
+        self.slots = threading.Semaphore(size)
+        self.broken = False
+        self.idle = []
+        self.workers = []
+        self.lock = threading.Lock()
+        atexit.register(self.close)
+
+    def run(self, job):
+        with self.slots:
+            with self.lock:
+                if self.broken:
+                    raise DocutilsError('docutils workers are unavailable')
+                worker = self.idle.pop() if self.idle else None
+
+            try:
+                if worker is None:
+                    worker = DocutilsWorker(self.python, self.environ)
+                    with self.lock:
+                        self.workers.append(worker)
+                worker.run(job)
+            except (DocutilsError, OSError):
+                if worker is None or worker.process.poll() is not None:
+                    self.broken = True
+                    worker = None
+                raise
+            finally:
+                if worker is not None:
+                    with self.lock:
+                        self.idle.append(worker)
+
+    def close(self):
+        with self.lock:
+            workers, self.workers, self.idle = self.workers, [], []
+        for worker in workers:
+            worker.close()
+
+
+DOCUTILS_POOLS = globals().get('DOCUTILS_POOLS', {})
+DOCUTILS_POOLS_LOCK = threading.Lock()
+
+
+def get_docutils_pool(env):
+    python = env.WhereIs(env['DOC_DOCUTILS_PYTHON']) or \
+        env['DOC_DOCUTILS_PYTHON']
+    with DOCUTILS_POOLS_LOCK:
+        if python not in DOCUTILS_POOLS:
+            environ = dict((str(k), str(v)) for k, v in env['ENV'].items())
+            size = int(env['DOC_DOCUTILS_WORKERS']) or \
+                multiprocessing.cpu_count()
+            DOCUTILS_POOLS[python] = DocutilsPool(python, environ, size)
+        return DOCUTILS_POOLS[python]
+
+
+def docutils_command(writer, tool, flags):
+    """Returns a generator for the builder running "tool flags $SOURCE
+    $TARGET", which publishes on a docutils worker if DOC_DOCUTILS is set. If
+    the worker fails, the tool is run to report the error."""
+    command = ' '.join([tool, flags, '$SOURCE', '$TARGET'])
+
+    def publish(target, source, env):
+        job = {'writer': writer,
+               'args': shlex.split(env.subst(flags, 0, target, source)),
+               'source': source[0].get_abspath(),
+               'target': target[0].get_abspath()}
+        try:
+            get_docutils_pool(env).run(job)
+        except (DocutilsError, OSError):
+            return Action(command, cmdstr=None)(target, source, env)
+        return 0
+
+    action = Action(publish, strfunction=lambda target, source, env:
+                    env.subst(command, 0, target, source))
+
+    def generator(source, target, env, for_signature):
+        if env['DOC_DOCUTILS'] and not for_signature:
+            return action
+        return command
+    return generator
+
+
+def pdf_jobs(env):
+    try:
+        jobs = int(env['PDF_JOBS'])
+    except ValueError:
+        raise BuildError(errstr='Not a valid number of jobs: %s' %
+                         env['PDF_JOBS'])
+    return jobs if jobs > 0 else multiprocessing.cpu_count()
+
+
+def pdf_fanout(env):
+    fanout = int(env['PDF_MERGE_FANOUT'])
+    if fanout < 2:
+        raise BuildError(errstr='PDF_MERGE_FANOUT must be at least 2, not %d'
+                         % fanout)
+    return fanout
+
+
+def run_tool(args, environ):
+    if subprocess.call(args, env=environ):
+        raise BuildError(errstr='%s failed' % ' '.join(args))
+
+
+def pdf_pipeline(env, sources, output, convert):
+    """Builds output from sources, which are images if convert is set and
+    PDFs otherwise. Images are converted on a pool of PDF_JOBS threads and
+    merged with pdftk in groups of PDF_MERGE_FANOUT pages while the following
+    pages are still converting. The groups are merged the same way until a
+    single file is left, so no pdftk run holds more than PDF_MERGE_FANOUT
+    inputs, and at most two pages per job wait on disk for their group."""
+    jobs = pdf_jobs(env)
+    fanout = pdf_fanout(env)
+    environ = dict((k, str(v)) for k, v in env['ENV'].items())
+    tmpdir = tempfile.mkdtemp(prefix='.pdf-', dir=os.path.dirname(output))
+    names = itertools.count()
+    pool = ThreadPool(jobs)
+
+    def temporary():
+        return os.path.join(tmpdir, '%d.pdf' % next(names))
+
+    def convert_page(source):
+        page = temporary()
+        run_tool(img_to_pdf_args(source, page), environ)
+        return page
+
+    def merge(inputs, remove):
+        merged = temporary()
+        run_tool(['pdftk'] + inputs + ['cat', 'output', merged], environ)
+        if remove:
+            for path in inputs:
+                os.remove(path)
+        return merged
+
+    def groups(paths):
+        return [paths[i:i + fanout] for i in range(0, len(paths), fanout)]
+
+    try:
+        if convert:
+            pending = collections.deque()
+            group = []
+            chunks = []
+            for i, source in enumerate(sources):
+                pending.append(pool.apply_async(convert_page, (source, )))
+                while pending and (len(pending) > 2 * jobs or
+                                   i == len(sources) - 1):
+                    group.append(pending.popleft().get())
+                    if len(group) == fanout or not pending:
+                        chunks.append(pool.apply_async(merge, (group, True)))
+                        group = []
+            level = [chunk.get() for chunk in chunks]
+        else:
+            level = pool.map(lambda group: merge(group, False),
+                             groups(sources))
+
+        while len(level) > fanout:
+            level = pool.map(lambda group: merge(group, True), groups(level))
+
+        if len(level) == 1:
+            os.rename(level[0], output)
+        else:
+            run_tool(['pdftk'] + level + ['cat', 'output', output], environ)
+    finally:
+        pool.terminate()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def convert_images(target, source, env):
+    pdf_pipeline(env, [str(s) for s in source], str(target[0]), True)
+
+
+def merge_pdfs(target, source, env):
+    pdf_pipeline(env, [str(s) for s in source], str(target[0]), False)
+
+
+def pipeline_string(tool):
+    def string(target, source, env):
+        return '%s: %d files -> %s' % (tool, len(source), target[0])
+    return string
+
+
+def img_to_pdf_generator(source, target, env, for_signature):
+    if len(source) == 1:
+        return ' '.join(img_to_pdf_args('$SOURCE', '$TARGET'))
+    if env['PDF_MERGE_INCREMENTAL']:
+        # the sources are pages converted by img_to_pdf_emitter already
+        return pdf_merge_generator(source, target, env, for_signature)
+    if for_signature:
+        return ' '.join(img_to_pdf_args('$SOURCES', '$TARGET'))
+    return Action(convert_images, pipeline_string('convert'))
+
+
+def pdf_merge_generator(source, target, env, for_signature):
+    command = 'pdftk $SOURCES cat output $TARGET'
+    if (for_signature or not env['PDF_PIPELINE'] or
+            len(source) <= pdf_fanout(env)):
+        return command
+    return Action(merge_pdfs, pipeline_string('pdftk'))
+
+
+def pdf_merge_emitter(target, source, env):
+    """With PDF_MERGE_INCREMENTAL set, sources are merged in a balanced tree of
+    intermediate PDFs next to the target, with up to PDF_MERGE_FANOUT inputs
+    per node. Changing one source rebuilds only the nodes above it."""
+    if not env['PDF_MERGE_INCREMENTAL']:
+        return target, source
+
+    fanout = pdf_fanout(env)
+    tree = target[0].dir.Dir(target[0].name + '.merge')
+    level = 0
+    while len(source) > fanout:
+        source = [env.PDFMerge(tree.File('%d-%d.pdf' % (level, i // fanout)),
+                               source[i:i + fanout],
+                               PDF_MERGE_INCREMENTAL=False)[0]
+                  for i in range(0, len(source), fanout)]
+        level += 1
+    return target, source
+
+
+def img_to_pdf_emitter(target, source, env):
+    """With PDF_MERGE_INCREMENTAL set, each image of a multi-page document is
+    converted to its own page in a TARGET.pages directory, and the pages are
+    merged like the sources of PDFMerge. Changing an image converts only its
+    page again."""
+    if not env['PDF_MERGE_INCREMENTAL'] or len(source) < 2:
+        return target, source
+
+    pages_dir = target[0].dir.Dir(target[0].name + '.pages')
+    names = [os.path.splitext(src.name)[0] for src in source]
+    pages = []
+    for i, src in enumerate(source):
+        # pages are named after their image, so that inserting one does not
+        # convert the following again
+        name = names[i] if names.count(names[i]) == 1 else \
+            '%s-%d' % (names[i], i)
+        pages.extend(env.ImgToPDF(pages_dir.File(name + '.pdf'), src))
+    return pdf_merge_emitter(target, pages, env)
+
+
 def generate(env):
-    # converts a JPEG with the right aspect ration to an A4 PDF page
-    img_to_pdf = Builder(action=' '.join(
-        ['convert', '$SOURCE', '-units', 'PixelsPerInch', '-density', '150',
-         '-quality', '80', '-resize', '%dx%d' % a4_dim_px, '$TARGET']),
-                         suffix='.pdf')
+    # converts a JPEG with the right aspect ration to an A4 PDF page. Several
+    # images are converted in parallel and merged into a single document
+    img_to_pdf = Builder(generator=img_to_pdf_generator, suffix='.pdf',
+                         emitter=img_to_pdf_emitter)
 
     # converts an SVG to PDF using inkscape
-    svg_to_pdf = Builder(action=' '.join(
-        ['inkscape', '--export-area-page', '--export-pdf=$TARGET', '$SOURCE']))
+    svg_to_pdf = Builder(generator=cached_command(' '.join(
+        ['inkscape', '--export-area-page', '--export-pdf=$TARGET', '$SOURCE']),
+        'inkscape --version'))
 
-    # concatenates PDF files using pdftk
-    pdf_merge = Builder(action='pdftk $SOURCES cat output $TARGET')
+    # concatenates PDF files using pdftk, in a tree of merges if PDF_PIPELINE
+    # or PDF_MERGE_INCREMENTAL is set
+    pdf_merge = Builder(generator=pdf_merge_generator,
+                        emitter=pdf_merge_emitter)
 
-    rst_to_html = Builder(action=' '.join(
-        ['rst2html', '--strict', '--math-output=MathJax', '$SOURCE', '$TARGET'
-         ]),
+    rst_to_html = Builder(generator=docutils_command(
+        'html', 'rst2html', '--strict --math-output=MathJax'),
                           suffix='.html',
-                          src_suffix='.rst')
-
-    rst_to_latex = Builder(action=' '.join(
-        ['rst2latex',
-         '--strict',
-         '--stylesheet=amsfonts,amssymb',
-         '$RST2LATEXFLAGS',
-         '$SOURCE',
-         '$TARGET', ]),
+                          src_suffix='.rst',
+                          source_scanner=rst_scanner)
+
+    rst_to_latex = Builder(generator=docutils_command(
+        'latex', 'rst2latex',
+        '--strict --stylesheet=amsfonts,amssymb $RST2LATEXFLAGS'),
                            suffix='.latex',
-                           src_suffix='.rst')
+                           src_suffix='.rst',
+                           source_scanner=rst_scanner)
 
-    rst_to_pdf = Builder(action=' '.join(
+    rst_to_pdf = Builder(generator=cached_command(' '.join(
         ['rst2pdf',
          '--compressed',
          # FIXME: should support language options
@@ -45,9 +667,10 @@ def generate(env):
          '>',
          '$TARGET',
          '<',
-         '$SOURCE', ]),
+         '$SOURCE', ]), 'rst2pdf --version'),
                          suffix='.pdf',
-                         src_suffix='.rst')
+                         src_suffix='.rst',
+                         source_scanner=rst_scanner)
 
     dot_to_pdf = Builder(action=' '.join([
         'dot',
@@ -56,7 +679,8 @@ def generate(env):
         '$SOURCE',
     ]),
                          suffix='.pdf',
-                         src_suffix='.dot', )
+                         src_suffix='.dot',
+                         source_scanner=dot_scanner)
 
     pdf_to_ps = Builder(action=' '.join([
         'pdf2ps',
@@ -86,6 +710,34 @@ def generate(env):
         'PS2PDF': ps_to_pdf,
     })
 
+    # directory caching the outputs of SVGToPDF and RST2PDF. None disables
+    # caching. OUTPUT_CACHE_SHARED names another cache directory, which is
+    # only read from
+    env.SetDefault(OUTPUT_CACHE_DIR=None)
+    env.SetDefault(OUTPUT_CACHE_SIZE=1024 ** 3)
+    env.SetDefault(OUTPUT_CACHE_SHARED=None)
+
+    # number of concurrent convert and pdftk processes in multi-page builds,
+    # 0 uses one per CPU
+    env.SetDefault(PDF_JOBS=0)
+    env.SetDefault(PDF_MERGE_FANOUT=64)
+    env.SetDefault(PDF_PIPELINE=False)
+
+    # keeps the merge tree of PDFMerge in a TARGET.merge directory, so that
+    # changing a source only remerges its path to the root. Small fanouts
+    # make for cheaper updates. ImgToPDF also keeps every converted page, in
+    # TARGET.pages
+    env.SetDefault(PDF_MERGE_INCREMENTAL=False)
+
+    # file keeping the results of the RST and DOT scanners between builds
+    env.SetDefault(DOC_SCAN_CACHE=None)
+
+    # publishes RST2HTML and RST2Latex targets on resident docutils workers,
+    # DOC_DOCUTILS_WORKERS of them (0 for one per CPU)
+    env.SetDefault(DOC_DOCUTILS=False)
+    env.SetDefault(DOC_DOCUTILS_PYTHON=sys.executable)
+    env.SetDefault(DOC_DOCUTILS_WORKERS=0)
+
 
 def exists(env):
     # we could detect if all tools are installed, however a user might want
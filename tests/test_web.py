@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# coding=utf8
+
+# Run with the SCons engine on the path, e.g.
+#   PYTHONPATH=/path/to/scons-engine python -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import web
+
+
+def requirements(suffix, contents):
+    return web.coffee_requirements(web.COFFEE_SCAN_RES[suffix], False,
+                                   contents)
+
+
+class CoffeeScanTest(unittest.TestCase):
+    def test_quote_in_js_regex(self):
+        contents = 'var q = /["\']/g, a = require("a");\n'
+        self.assertEqual(requirements('.js', contents), ['a'])
+
+    def test_quote_in_coffee_regex(self):
+        contents = 'quotes = /["\']/\nif /\'/.test(s) then b = require \'b\'\n'
+        self.assertEqual(requirements('.coffee', contents), ['b'])
+
+    def test_coffee_heregex(self):
+        contents = 'r = ///\n  "(require \'x\') # \'\n///\nc = require \'c\'\n'
+        self.assertEqual(requirements('.coffee', contents), ['c'])
+
+    def test_division_is_no_regex(self):
+        contents = 'x = a / 2; y = require("d") / 3;\n'
+        self.assertEqual(requirements('.js', contents), ['d'])
+
+    def test_requires_in_strings_and_comments(self):
+        contents = ('s = "require(\'s\')"; // require("t")\n'
+                    '/* require("u") */ var e = require("e");\n')
+        self.assertEqual(requirements('.js', contents), ['e'])
+
+    def test_unterminated_string_ends_at_newline(self):
+        contents = 's = "unterminated\nf = require("f")\n'
+        self.assertEqual(requirements('.js', contents), ['f'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,13 +6,31 @@
 Supports building of LESS, Dart and CoffeeScript files.
 """
 
+import atexit
+import gzip
+import hashlib
+import io
+import json
 import os
 import re
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+from urllib import quote, unquote
 from urlparse import urlparse
 
 from SCons.Script import *
+from SCons.Errors import BuildError
 import SCons.Warnings
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 
 class UnknownDependencyWarning(SCons.Warnings.Warning):
     pass
@@ -36,6 +54,124 @@ def get_jar(env, jarname):
 #################################################
 SCANNERS = []
 
+
+class ScanCache(object):
+    """Persistent cache of scan results, keyed by the content signature of the
+    scanned file.
+
+    SCons computes the signature of every source anyway, so a hit saves
+    reading and scanning the file. Entries are stored in a JSON file, which is
+    written when SCons exits if anything was added. Every write starts a new
+    generation; entries not used in the last max_generations are dropped, so
+    the results for old versions of a file do not pile up."""
+
+    def __init__(self, path, max_generations):
+        self.path = path
+        self.max_generations = max_generations
+        self.hits = 0
+        self.misses = 0
+        self.entries = {}
+        self.used = {}
+        self.generation = 1
+        self.dirty = False
+
+        try:
+            with open(path) as cache_file:
+                data = json.load(cache_file)
+            self.generation = data['generation'] + 1
+            for key, (used, value) in data['entries'].items():
+                self.entries[key] = value
+                self.used[key] = used
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
+
+        atexit.register(self.save)
+
+    def lookup(self, kind, node, scan):
+        return self.get('%s:%s' % (kind, node.get_csig()),
+                        lambda: scan(node.get_text_contents()))
+
+    def get(self, key, compute):
+        self.used[key] = self.generation
+        if key in self.entries:
+            self.hits += 1
+            return self.entries[key]
+
+        self.misses += 1
+        result = compute()
+        self.entries[key] = result
+        self.dirty = True
+        return result
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self.entries)}
+
+    def report(self):
+        print('scan cache %s: %d hits, %d misses' %
+              (self.path, self.hits, self.misses))
+
+    def save(self):
+        if not self.dirty:
+            return
+
+        oldest = self.generation - self.max_generations
+        entries = dict((key, [self.used[key], value])
+                       for key, value in self.entries.items()
+                       if self.used[key] > oldest)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as cache_file:
+            json.dump({'generation': self.generation, 'entries': entries},
+                      cache_file)
+        os.rename(tmp_path, self.path)
+        self.dirty = False
+
+
+# SCons on python 2 executes this module again for every environment loading
+# the tool. Registries of caches, pools and counters are module globals kept
+# across these reloads, so that all environments share them
+SCAN_CACHES = globals().get('SCAN_CACHES', {})
+
+
+def get_scan_cache(env):
+    if not env['WEB_SCAN_CACHE']:
+        return None
+
+    path = env.File(env['WEB_SCAN_CACHE']).get_abspath()
+    if path not in SCAN_CACHES:
+        SCAN_CACHES[path] = ScanCache(
+            path, int(env['WEB_SCAN_CACHE_GENERATIONS']))
+        if env['WEB_SCAN_CACHE_STATS']:
+            atexit.register(SCAN_CACHES[path].report)
+    return SCAN_CACHES[path]
+
+
+def scan_cached(env, kind, node, scan):
+    """Returns scan(contents of node), through the scan cache if enabled."""
+    cache = get_scan_cache(env)
+    if cache is None:
+        return scan(node.get_text_contents())
+    return cache.lookup(kind, node, scan)
+
+
+def scan_cache_stats(env):
+    cache = get_scan_cache(env)
+    return cache.stats() if cache else None
+
+
+def cache_stats():
+    """Hits and misses of the scan and output caches, for the buildstats
+    tool."""
+    stats = {}
+    for path, cache in SCAN_CACHES.items():
+        stats['web scan cache %s' % path] = {'hits': cache.hits,
+                                             'misses': cache.misses}
+    for path, cache in OUTPUT_CACHES.items():
+        stats['web output cache %s' % path] = {'hits': cache.hits,
+                                               'misses': cache.misses}
+    return stats
+
+
 # note: this is far from accurate or correct,
 #       but should handle 99% of the common cases
 LESS_IMPORT_RE = re.compile('@import\s+' +
@@ -44,9 +180,13 @@ LESS_IMPORT_RE = re.compile('@import\s+' +
                             '\s*;')
 
 
+def less_imports(contents):
+    return LESS_IMPORT_RE.findall(contents)
+
+
 def less_scan(node, env, path):
     include_path = (node.get_dir(),) + tuple(path)
-    for fn in LESS_IMPORT_RE.findall(node.get_text_contents()):
+    for fn in scan_cached(env, 'less', node, less_imports):
         n = SCons.Node.FS.find_file(fn, include_path)
         if n == None:
             # try adding a .less ending
@@ -64,18 +204,145 @@ SCANNERS.append(Scanner(function=less_scan, skeys=['.less'],
                         recursive=True))
 
 
-def dart2js_scan(node, env, path):
-    deps_fn = str(node) + '.js.deps'
-    if os.path.exists(deps_fn):
-        with open(deps_fn) as deps_file:
-            for line in deps_file:
-                o = urlparse(line.strip())
-                if not o.scheme == 'file':
-                    SCons.Warnings.warn(UnknownDependencyWarning,
-                                        'Cannot handle dependency "%s"' % line)
+# dart2js lists the files read for a target in its .deps file. Parsed deps
+# files are memoized by their contents and kept in the scan cache, package
+# maps are memoized by mtime and size. package: URIs are resolved through the
+# package map of the application (.dart_tool/package_config.json or
+# .packages, searched for from the directory of the source upwards, or
+# DART_PACKAGE_MAP)
+DART_DEPS = globals().get('DART_DEPS', {})
+DART_DEP_NODES = globals().get('DART_DEP_NODES', {})
+DART_PACKAGE_MAPS = globals().get('DART_PACKAGE_MAPS', {})
+DART_PACKAGE_MAP_PATHS = globals().get('DART_PACKAGE_MAP_PATHS', {})
+WARNED_DEPENDENCIES = globals().get('WARNED_DEPENDENCIES', set())
+
+
+def uri_path(uri, base):
+    """Returns the path of a file: or relative URI, None for other URIs."""
+    o = urlparse(uri)
+    if o.scheme == 'file':
+        return unquote(o.path)
+    if not o.scheme:
+        return os.path.normpath(os.path.join(base, unquote(o.path)))
+    return None
+
+
+def parse_dart_deps(contents):
+    """Splits the URIs of a deps file into files, [package, path] pairs and
+    others."""
+    deps = {'files': [], 'packages': [], 'others': []}
+    for line in contents.splitlines():
+        uri = line.strip()
+        if uri.startswith('file:'):
+            deps['files'].append(unquote(urlparse(uri).path))
+        elif uri.startswith('package:'):
+            package, _, path = uri[len('package:'):].partition('/')
+            deps['packages'].append([package, unquote(path)])
+        elif uri:
+            deps['others'].append(uri)
+    return deps
+
+
+def read_package_map(path):
+    """Returns a dict mapping package names to their library directories."""
+    base = os.path.dirname(path)
+    packages = {}
+    with open(path) as map_file:
+        if path.endswith('.json'):
+            # rootUri is relative to the .dart_tool directory
+            for package in json.load(map_file).get('packages', []):
+                root = uri_path(package['rootUri'], base)
+                if root is not None:
+                    packages[package['name']] = os.path.join(
+                        root, unquote(package.get('packageUri', '')))
+        else:
+            for line in map_file:
+                line = line.strip()
+                if not line or line.startswith('#'):
                     continue
+                package, _, uri = line.partition(':')
+                lib_dir = uri_path(uri, base)
+                if lib_dir is not None:
+                    packages[package] = lib_dir
+    return packages
+
+
+def find_package_map(env, node):
+    if env['DART_PACKAGE_MAP']:
+        return env.File(env['DART_PACKAGE_MAP']).get_abspath()
+
+    start = directory = os.path.dirname(node.get_abspath())
+    if start not in DART_PACKAGE_MAP_PATHS:
+        found = None
+        while found is None:
+            for name in ('.dart_tool/package_config.json', '.packages'):
+                if os.path.exists(os.path.join(directory, name)):
+                    found = os.path.join(directory, name)
+                    break
+            parent = os.path.dirname(directory)
+            if parent == directory:
+                break
+            directory = parent
+        DART_PACKAGE_MAP_PATHS[start] = found
+    return DART_PACKAGE_MAP_PATHS[start]
+
+
+def get_package_map(path):
+    """Returns (stamp, packages) of the package map at path."""
+    try:
+        stamp = file_stamp(path)
+    except (OSError, TypeError):
+        return None, {}
+    if stamp not in DART_PACKAGE_MAPS:
+        try:
+            DART_PACKAGE_MAPS[stamp] = read_package_map(path)
+        except (IOError, ValueError, KeyError):
+            DART_PACKAGE_MAPS[stamp] = {}
+    return stamp, DART_PACKAGE_MAPS[stamp]
+
+
+def warn_dependency(uri):
+    if uri not in WARNED_DEPENDENCIES:
+        WARNED_DEPENDENCIES.add(uri)
+        SCons.Warnings.warn(UnknownDependencyWarning,
+                            'Cannot handle dependency "%s"' % uri)
+
 
-                yield env.File(o.path)
+def dart2js_scan(node, env, path):
+    deps_fn = os.path.abspath(str(node) + '.js.deps')
+    try:
+        with open(deps_fn, 'rb') as deps_file:
+            contents = deps_file.read()
+    except IOError:
+        return []
+
+    # dart2js rewrites the deps file on every run, possibly within the same
+    # second and with the same size, so it is told apart by its contents
+    stamp = hashlib.md5(contents).hexdigest()
+    if stamp not in DART_DEPS:
+        read = lambda: parse_dart_deps(contents.decode('utf8'))
+        cache = get_scan_cache(env)
+        DART_DEPS[stamp] = (cache.get('dart2js-deps:' + stamp, read)
+                            if cache else read())
+    deps = DART_DEPS[stamp]
+
+    map_stamp, packages = get_package_map(find_package_map(env, node)) \
+        if deps['packages'] else (None, {})
+
+    key = (stamp, map_stamp)
+    if key not in DART_DEP_NODES:
+        paths = list(deps['files'])
+        for package, package_path in deps['packages']:
+            if package in packages:
+                paths.append(os.path.join(packages[package], package_path))
+            else:
+                warn_dependency('package:%s/%s' % (package, package_path))
+        for uri in deps['others']:
+            # libraries of the sdk are not part of the project
+            if not uri.startswith('dart:'):
+                warn_dependency(uri)
+        DART_DEP_NODES[key] = [env.File(p) for p in sorted(set(paths))]
+    return DART_DEP_NODES[key]
 
 SCANNERS.append(Scanner(function=dart2js_scan,
                         skeys=['.dart']))
@@ -83,22 +350,71 @@ SCANNERS.append(Scanner(function=dart2js_scan,
 
 # coffee-script code MIT-licensed, originally written by Joe Koberg
 # altered by Marc Brinkmann
-COFFEE_REQUIRE_PATTERNS = [
-    re.compile(pattern, re.MULTILINE)
-    for pattern in [
-        r"""require\s*\(*\s*['"]([^.].*?)['"]\)*""",
-        r"""require\s*\(*\s*['"](\./.*?)['"]\)*""",
-        r"""require\s*\(*\s*['"](\.\./.*?)['"]\)*""",
-        ]
-    ]
-
-COFFEE_DEFINE_PATTERNS = [
-    re.compile(pattern, re.MULTILINE)
-    for pattern in [
-        r"""define\s*\(*\s*\[(.+?)\]""",
-        r"""require\s*\(*\s*\[(.+?)\]""",
-        ]
-    ]
+COFFEE_REQUIRE_PATTERN = r"""\brequire\s*\(*\s*['"](?P<require>[^.].*?|\.\.?/.*?)['"]"""
+COFFEE_DEFINE_PATTERN = r"""\b(?:define|require)\s*\(*\s*\[(?P<define>.+?)\]"""
+
+# a regular expression literal, where an operand is expected: after an
+# operator, an opening bracket or a keyword. Elsewhere a slash divides
+REGEX_LITERAL_PATTERN = r"""/(?![/*])(?:\\.|\[(?:\\.|[^\]\\\n])*\]|[^/\\\n\[])+/"""
+JS_REGEX_PATTERN = (r"""(?:[\n=(,:;!&|?{}\[+\-*%<>~^]|\b(?:return|typeof|case))"""
+                    r"""[ \t]*""" + REGEX_LITERAL_PATTERN)
+COFFEE_REGEX_PATTERN = (r"""(?:[\n=(,:;!&|?{}\[+\-*%<>~^]|"""
+                        r"""\b(?:return|and|or|not|is|isnt|if|unless|when|"""
+                        r"""then|else|in|of|yield))[ \t]*""" +
+                        REGEX_LITERAL_PATTERN)
+
+# comments, strings and regular expressions are matched as a whole, so that
+# require() calls inside them are skipped and quotes in them open no string
+JS_SKIP_PATTERNS = [
+    JS_REGEX_PATTERN,
+    r"""//[^\n]*""",
+    r"""/\*[\s\S]*?\*/""",
+    r"""'(?:\\.|[^'\\\n])*'""",
+    r'''"(?:\\.|[^"\\\n])*"''',
+]
+
+COFFEE_SKIP_PATTERNS = [
+    r"""///[\s\S]*?///""",
+    COFFEE_REGEX_PATTERN,
+    r"""###[\s\S]*?###""",
+    r"""#[^\n]*""",
+    r"""'''[\s\S]*?'''""",
+    r'''"""[\s\S]*?"""''',
+    r"""'(?:\\.|[^'\\\n])*'""",
+    r'''"(?:\\.|[^"\\\n])*"''',
+]
+
+# a single pass over the contents finds all requirements
+COFFEE_SCAN_RES = dict(
+    (suffix, re.compile('|'.join([COFFEE_REQUIRE_PATTERN,
+                                  COFFEE_DEFINE_PATTERN] + skip_patterns)))
+    for suffix, skip_patterns in [('.js', JS_SKIP_PATTERNS),
+                                  ('.coffee', COFFEE_SKIP_PATTERNS)]
+)
+
+# files with lines longer than this on average are considered minified
+MINIFIED_LINE_LENGTH = 1000
+
+
+def is_minified(contents):
+    head = contents[:64 * 1024]
+    return len(head) > 4096 and\
+        len(head) > MINIFIED_LINE_LENGTH * (head.count('\n') + 1)
+
+
+def coffee_requirements(pattern, skip_minified, contents):
+    if skip_minified and is_minified(contents):
+        return []
+
+    requirements = []
+    for match in pattern.finditer(contents):
+        if match.group('require') is not None:
+            requirements.append(match.group('require'))
+        elif match.group('define') is not None:
+            requirements.extend(s.strip().strip('"\'')
+                                for s in match.group('define').split(','))
+    return requirements
+
 
 def coffee_glob_requirement_name(env, node, name):
     if not name.startswith('_'):
@@ -122,26 +438,276 @@ def coffee_glob_requirement_name(env, node, name):
 
 
 def coffee_scan(node, env, path):
-    contents = node.get_text_contents()
-    requirements = []
-
-    for pattern in COFFEE_REQUIRE_PATTERNS:
-        for match in pattern.finditer(contents):
-            requirement = match.group(1)
-            for found in coffee_glob_requirement_name(env, node, requirement):
-                yield found
-
-    for pattern in COFFEE_DEFINE_PATTERNS:
-        for match in pattern.finditer(contents):
-            define_strings = [s.strip().strip('"\'') for s in match.group(1).split(',')]
-            for requirement in define_strings:
-                for found in coffee_glob_requirement_name(env, node, requirement):
-                    yield found
+    suffix = '.coffee' if str(node).endswith('.coffee') else '.js'
+    skip_minified = env['COFFEE_SKIP_MINIFIED']
+    if skip_minified and str(node).endswith('.min.js'):
+        return
+
+    kind = suffix[1:] + ('-skipminified' if skip_minified else '')
+    scan = lambda contents: coffee_requirements(COFFEE_SCAN_RES[suffix],
+                                                skip_minified, contents)
+    for requirement in scan_cached(env, kind, node, scan):
+        for found in coffee_glob_requirement_name(env, node, requirement):
+            yield found
 SCANNERS.append(Scanner(function = coffee_scan,
                         skeys = ['.coffee', '.js']))
 
 
 
+#################################################
+# TOOL FINGERPRINTS
+#################################################
+# the compiler is part of the signature of its targets, so upgrading it
+# rebuilds them. A fingerprint is the path of the tool and its --version
+# output, or the hash of the jar for tools run by java. It is computed once
+# per build and, with WEB_SCAN_CACHE, kept across builds until the mtime or
+# size of the tool or the jar changes
+FINGERPRINTS = globals().get('FINGERPRINTS', {})
+
+
+def file_stamp(path):
+    st = os.stat(path)
+    return '%s:%r:%d' % (path, st.st_mtime, st.st_size)
+
+
+def compute_fingerprint(env, tool_path, jar):
+    if jar:
+        digest = hashlib.sha1()
+        with open(jar, 'rb') as jar_file:
+            for chunk in iter(lambda: jar_file.read(1024 * 1024), b''):
+                digest.update(chunk)
+        version = digest.hexdigest()
+    else:
+        try:
+            proc = subprocess.Popen([tool_path, '--version'],
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT,
+                                    env=worker_environ(env))
+            version = proc.communicate()[0].decode('utf8', 'replace')
+        except OSError:
+            version = ''
+    return ' '.join([tool_path] + version.split())
+
+
+def tool_fingerprint(env, tool, jar=None):
+    """Returns a string identifying the version of tool, or of jar if tool is
+    the java runtime running it."""
+    if jar:
+        jar = os.path.abspath(os.path.expanduser(jar))
+    # fingerprints are asked for with every signature, the tool is only
+    # looked up on the path the first time
+    path_key = (tool, jar, str(env['ENV'].get('PATH')))
+    if path_key in FINGERPRINTS:
+        return FINGERPRINTS[path_key]
+
+    # JAVA may include options
+    name = shlex.split(tool)[0]
+    tool_path = env.WhereIs(name) or name
+    key = (tool_path, jar)
+    if key not in FINGERPRINTS:
+        try:
+            stamps = [file_stamp(os.path.realpath(path))
+                      for path in (tool_path, jar) if path]
+        except OSError:
+            # not installed, there is no version to tell apart
+            FINGERPRINTS[key] = ' '.join(path for path in key if path)
+        else:
+            compute = lambda: compute_fingerprint(env, tool_path, jar)
+            cache = get_scan_cache(env)
+            if cache:
+                FINGERPRINTS[key] = cache.get('tool:' + ' '.join(stamps),
+                                              compute)
+            else:
+                FINGERPRINTS[key] = compute()
+    FINGERPRINTS[path_key] = FINGERPRINTS[key]
+    return FINGERPRINTS[key]
+
+
+def signed_command(command, fingerprint):
+    """Returns command with the tool fingerprint appended. Only used for
+    signatures, the command is never run."""
+    return '%s %s' % (command, fingerprint.replace('$', '$$'))
+
+
+#################################################
+# OUTPUT CACHE
+#################################################
+class OutputCache(object):
+    """Content-addressed store of the targets of expensive external tools.
+
+    Entries are keyed by the dependencies' content signatures, the expanded
+    command line and the version of the tool, so they can be reused across
+    branches and checkouts. Each entry is a directory holding the targets by
+    index. Entries are touched on use; eviction at exit removes those with
+    the oldest mtime until the cache fits into max_size. An optional shared
+    cache, e.g. on a network mount, is only ever read from.
+
+    Targets listed in relocate contain absolute paths of the checkout that
+    built them. The top directory is replaced by a placeholder when they are
+    stored and by the top directory of the build using them when restored."""
+
+    def __init__(self, path, max_size, shared=None):
+        self.path = path
+        self.max_size = max_size
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        atexit.register(self.evict)
+
+    def entry_path(self, root, key):
+        return os.path.join(root, key[:2], key)
+
+    def get(self, key, target, relocate=(), top=None):
+        for root in (self.path, self.shared):
+            entry = self.entry_path(root, key) if root else None
+            if not entry or not os.path.isdir(entry):
+                continue
+            try:
+                for index, tgt in enumerate(target):
+                    copy_relocated(os.path.join(entry, str(index)),
+                                   tgt.get_abspath(),
+                                   [(placeholder, path) for path, placeholder
+                                    in top_dir_forms(top)]
+                                   if index in relocate else ())
+                if root == self.path:
+                    os.utime(entry, None)
+            except (IOError, OSError):
+                continue
+            self.hits += 1
+            return True
+
+        self.misses += 1
+        return False
+
+    def put(self, key, target, relocate=(), top=None):
+        entry = self.entry_path(self.path, key)
+        tmp_entry = '%s.tmp-%d-%d' % (entry, os.getpid(),
+                                      threading.current_thread().ident)
+        try:
+            os.makedirs(tmp_entry)
+            for index, tgt in enumerate(target):
+                copy_relocated(tgt.get_abspath(),
+                               os.path.join(tmp_entry, str(index)),
+                               top_dir_forms(top) if index in relocate else ())
+            os.rename(tmp_entry, entry)
+        except (IOError, OSError):
+            # stored by a parallel build already, or not writable
+            shutil.rmtree(tmp_entry, True)
+            return
+        self.dirty = True
+
+    def evict(self):
+        if not self.dirty:
+            return
+
+        entries = []
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            if dirpath == self.path:
+                continue
+            for dirname in dirnames:
+                entry = os.path.join(dirpath, dirname)
+                try:
+                    size = sum(os.path.getsize(os.path.join(entry, name))
+                               for name in os.listdir(entry))
+                    entries.append((os.path.getmtime(entry), size, entry))
+                except OSError:
+                    continue
+                total += size
+            del dirnames[:]
+
+        entries.sort()
+        for mtime, size, entry in entries:
+            if total <= self.max_size:
+                break
+            shutil.rmtree(entry, True)
+            total -= size
+        self.dirty = False
+
+
+def top_dir_forms(top):
+    """Returns the top directory, as it appears in file: URIs and as a plain
+    path, along with the placeholders replacing it in the cache."""
+    return [(quote(top).encode('utf8'), b'@SCONS_TOP_DIR_URI@'),
+            (top.encode('utf8'), b'@SCONS_TOP_DIR@')]
+
+
+def copy_relocated(src, dst, replacements):
+    if not replacements:
+        shutil.copyfile(src, dst)
+        return
+    with open(src, 'rb') as src_file:
+        contents = src_file.read()
+    for old, new in replacements:
+        contents = contents.replace(old, new)
+    with open(dst, 'wb') as dst_file:
+        dst_file.write(contents)
+
+
+OUTPUT_CACHES = globals().get('OUTPUT_CACHES', {})
+
+
+def get_output_cache(env):
+    path = env.Dir(env['OUTPUT_CACHE_DIR']).get_abspath()
+    if path not in OUTPUT_CACHES:
+        shared = env['OUTPUT_CACHE_SHARED']
+        OUTPUT_CACHES[path] = OutputCache(
+            path, int(env['OUTPUT_CACHE_SIZE']),
+            env.Dir(shared).get_abspath() if shared else None)
+    return OUTPUT_CACHES[path]
+
+
+def use_output_cache(env, for_signature):
+    return env['OUTPUT_CACHE_DIR'] and not for_signature
+
+
+def output_cache_key(env, target, source, command, fingerprint):
+    key = hashlib.sha1(fingerprint.encode('utf8'))
+    key.update(env.subst(command, 2, target, source).encode('utf8'))
+    for child in target[0].children():
+        key.update(('\0%s\0%s' % (child, child.get_csig())).encode('utf8'))
+    return key.hexdigest()
+
+
+def output_cache_action(action, command, fingerprint, relocate=()):
+    """Returns an action running action, unless its targets are found in the
+    output cache.
+
+    command is the command line run by action, fingerprint the one of the
+    tool running it. relocate are the indexes of targets holding absolute
+    paths."""
+    action = Action(action)
+
+    def build_cached(target, source, env):
+        cache = get_output_cache(env)
+        key = output_cache_key(env, target, source, command, fingerprint)
+        top = env.Dir('#').get_abspath()
+        if cache.get(key, target, relocate, top):
+            return 0
+
+        status = action(target, source, env, show=False)
+        if not status:
+            cache.put(key, target, relocate, top)
+        return status
+
+    return Action(build_cached, strfunction=lambda target, source, env:
+                  env.subst(command, 0, target, source))
+
+
+def cached_command(command, tool, relocate=()):
+    """Returns a generator running command through the output cache."""
+    def generator(source, target, env, for_signature):
+        fingerprint = tool_fingerprint(env, tool)
+        if for_signature:
+            return signed_command(command, fingerprint)
+        if use_output_cache(env, for_signature):
+            return output_cache_action(command, command, fingerprint,
+                                       relocate)
+        return command
+    return generator
+
+
 #################################################
 # BUILDERS
 #################################################
@@ -153,13 +719,631 @@ def dart_emitter(target, source, env):
     target.append(str(target[0]) + '.map')
     return target, source
 
-BUILDERS['Dart2Js'] = Builder(action='dart2js -c $SOURCE -o$TARGET',
+# the .deps and .map files name sources by their absolute paths
+BUILDERS['Dart2Js'] = Builder(generator=cached_command(
+                                  'dart2js -c $SOURCE -o$TARGET', 'dart2js',
+                                  relocate=(1, 2)),
                               suffix='.dart.js',
                               src_suffix='.dart',
                               emitter=dart_emitter,
                               single_source=True)
 
 
+# with WEB_PRECOMPRESS set to a list of encodings ('gz', 'br'), the outputs of
+# Less, UglifyJs, Closure and HtmlComp get compressed siblings (app.js.gz),
+# so a static file server can send them as they are. Siblings are targets of
+# their own: they are compressed in parallel with -j and only when the content
+# of the output changed
+def asset_emitter(target, source, env):
+    for tgt in target:
+        if env['WEB_PRECOMPRESS']:
+            env.Precompress(['%s.%s' % (tgt, encoding)
+                             for encoding in env['WEB_PRECOMPRESS']], tgt)
+    return target, source
+
+
+def gzip_compress(data):
+    out = io.BytesIO()
+    # no file name and mtime, so that equal outputs compress equally
+    with gzip.GzipFile('', 'wb', 9, out, mtime=0) as gz:
+        gz.write(data)
+    return out.getvalue()
+
+
+def brotli_compress(data):
+    if brotli is None:
+        raise BuildError(errstr='.br files require the brotli module')
+    return brotli.compress(data, mode=brotli.MODE_TEXT, quality=11)
+
+
+COMPRESSORS = {'gz': gzip_compress, 'br': brotli_compress}
+
+
+def precompress(target, source, env):
+    with open(source[0].get_abspath(), 'rb') as src:
+        data = src.read()
+
+    for tgt in target:
+        encoding = tgt.get_path().rsplit('.', 1)[-1]
+        if encoding not in COMPRESSORS:
+            raise BuildError(errstr='Unknown encoding %s' % encoding)
+        with open(tgt.get_abspath(), 'wb') as out:
+            out.write(COMPRESSORS[encoding](data))
+
+BUILDERS['Precompress'] = Builder(action=Action(
+    precompress, 'Compressing $SOURCE to $TARGETS'))
+DEFAULTS['WEB_PRECOMPRESS'] = []
+
+
+def hashed_name(node, length):
+    """Inserts the first length characters of the content signature of node
+    before its extension: app.min.js becomes app.min.0123abcd.js."""
+    root, ext = os.path.splitext(node.name)
+    return '%s.%s%s' % (root, node.get_csig()[:length], ext)
+
+
+def manifest_emitter(target, source, env):
+    # the manifest copies the compressed siblings along with the assets
+    for src in source:
+        for encoding in env['WEB_PRECOMPRESS']:
+            sibling = env.File('%s.%s' % (src, encoding))
+            if sibling.has_builder():
+                env.Depends(target, sibling)
+    return target, source
+
+
+def asset_manifest(target, source, env):
+    """Copies each source, and its compressed siblings, to a hashed name
+    next to it, then writes a JSON manifest mapping the paths of the sources
+    to the hashed paths, both relative to the manifest. Hashed files of
+    earlier builds are left alone, as cached pages may still refer to them."""
+    base = target[0].dir.get_abspath()
+    manifest = {}
+    for src in source:
+        path = src.get_abspath()
+        hashed = os.path.join(os.path.dirname(path),
+                              hashed_name(src, env['WEB_ASSET_HASH_LENGTH']))
+        for suffix in [''] + ['.' + enc for enc in env['WEB_PRECOMPRESS']]:
+            if os.path.exists(path + suffix) and \
+                    not os.path.exists(hashed + suffix):
+                shutil.copyfile(path + suffix, hashed + suffix)
+        manifest[os.path.relpath(path, base).replace(os.sep, '/')] = \
+            os.path.relpath(hashed, base).replace(os.sep, '/')
+
+    with open(target[0].get_abspath(), 'w') as out:
+        out.write(json.dumps(manifest, indent=2, sort_keys=True,
+                             separators=(',', ': ')))
+
+BUILDERS['AssetManifest'] = Builder(
+    action=Action(asset_manifest,
+                  'Writing asset manifest $TARGET',
+                  varlist=['WEB_ASSET_HASH_LENGTH', 'WEB_PRECOMPRESS']),
+    emitter=manifest_emitter,
+    suffix='.json')
+DEFAULTS['WEB_ASSET_HASH_LENGTH'] = 8
+
+
+#################################################
+# NODE WORKERS
+#################################################
+# compiles jobs sent as JSON lines on stdin, answering each with a JSON line
+# on stdout. compilers are loaded as node modules, installed locally or
+# globally
+NODE_WORKER_SCRIPT = r"""
+var fs = require('fs');
+var path = require('path');
+var readline = require('readline');
+
+// stdout carries the responses only, whatever compilers print goes to stderr
+var respond = process.stdout.write.bind(process.stdout);
+process.stdout.write = process.stderr.write.bind(process.stderr);
+console.log = console.info = console.error;
+
+var globalRoot = path.join(path.dirname(process.execPath), '..', 'lib',
+                           'node_modules');
+
+function load(names) {
+  for (var i = 0; i < names.length; i++) {
+    try { return require(names[i]); } catch (e) {}
+    try { return require(path.join(globalRoot, names[i])); } catch (e) {}
+  }
+  throw new Error('Cannot find module ' + names.join(' or '));
+}
+
+function read(fn) { return fs.readFileSync(fn, 'utf8'); }
+
+var compilers = {
+  less: function(job, done) {
+    var options = job.options;
+    options.filename = job.sources[0];
+    load(['less']).render(read(job.sources[0]), options).then(
+      function(output) { done(null, output.css); }, done);
+  },
+  coffee: function(job, done) {
+    var coffee = load(['coffeescript', 'coffee-script']);
+    done(null, job.sources.map(function(fn) {
+      return coffee.compile(read(fn), {bare: job.options.bare, filename: fn});
+    }).join('\n'));
+  },
+  uglifyjs: function(job, done) {
+    var code = {};
+    job.sources.forEach(function(fn) { code[fn] = read(fn); });
+    var result = load(['uglify-js']).minify(code, job.options);
+    if (result.error) throw result.error;
+    done(null, result.code);
+  }
+};
+
+readline.createInterface({input: process.stdin}).on('line', function(line) {
+  function done(error, output) {
+    respond(JSON.stringify(error ?
+      {error: String(error.message || error)} : {output: output}) + '\n');
+  }
+  try {
+    var job = JSON.parse(line);
+    compilers[job.tool](job, done);
+  } catch (e) {
+    done(e);
+  }
+});
+"""
+
+
+class WorkerError(Exception):
+    pass
+
+
+class WorkerCrashed(WorkerError):
+    pass
+
+
+class NodeWorker(object):
+    """A node process compiling one job at a time."""
+
+    def __init__(self, node, environ):
+        self.process = subprocess.Popen([node, '-e', NODE_WORKER_SCRIPT],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        env=environ)
+
+    def run(self, job):
+        try:
+            self.process.stdin.write(json.dumps(job).encode('utf8') + b'\n')
+            self.process.stdin.flush()
+            line = self.process.stdout.readline()
+        except (IOError, OSError) as e:
+            raise WorkerCrashed(str(e))
+
+        if not line:
+            raise WorkerCrashed('worker exited with %s' % self.process.wait())
+
+        # anything but a response means the worker lost track of its jobs
+        try:
+            response = json.loads(line.decode('utf8'))
+        except ValueError:
+            response = None
+        if not isinstance(response, dict) or not (
+                'error' in response or 'output' in response):
+            raise WorkerCrashed('unexpected output: %s' %
+                                line.decode('utf8', 'replace').strip())
+        if 'error' in response:
+            raise WorkerError(response['error'])
+        return response['output']
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def kill(self):
+        try:
+            self.process.kill()
+        except OSError:
+            pass
+        self.process.wait()
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        self.process.wait()
+
+
+class WorkerPool(object):
+    """Resident worker processes, shared by all actions running in parallel.
+
+    Workers are started on demand by calling start_worker, at most size of
+    them (unlimited if size is None); further jobs wait for a worker to become
+    idle. A worker that crashes is replaced and the job is retried once. If
+    the retry crashes as well, the pool gives up and refuses all further
+    jobs, so a broken setup does not start two processes for every target."""
+
+    def __init__(self, start_worker, size=None):
+        self.start_worker = start_worker
+        self.slots = threading.Semaphore(size) if size else None
+        self.broken = False
+        self.idle = []
+        self.workers = []
+        self.lock = threading.Lock()
+        atexit.register(self.close)
+
+    def acquire(self):
+        if self.slots:
+            self.slots.acquire()
+        try:
+            with self.lock:
+                if self.idle:
+                    return self.idle.pop()
+            worker = self.start_worker()
+        except:
+            if self.slots:
+                self.slots.release()
+            raise
+        with self.lock:
+            self.workers.append(worker)
+        return worker
+
+    def release(self, worker):
+        with self.lock:
+            if worker.alive():
+                self.idle.append(worker)
+            else:
+                self.workers.remove(worker)
+        if self.slots:
+            self.slots.release()
+
+    def run(self, job):
+        for attempt in range(2):
+            if self.broken:
+                raise WorkerError('workers are unavailable')
+            try:
+                worker = self.acquire()
+            except OSError as e:
+                self.broken = True
+                raise WorkerCrashed(str(e))
+            try:
+                return worker.run(job)
+            except WorkerCrashed:
+                worker.kill()
+                if attempt:
+                    self.broken = True
+                    raise
+            finally:
+                self.release(worker)
+
+    def close(self):
+        with self.lock:
+            workers, self.workers, self.idle = self.workers, [], []
+        for worker in workers:
+            worker.close()
+
+
+WORKER_POOLS = globals().get('WORKER_POOLS', {})
+WORKER_POOLS_LOCK = threading.Lock()
+
+
+def get_worker_pool(key, start_worker, size=None):
+    with WORKER_POOLS_LOCK:
+        if key not in WORKER_POOLS:
+            WORKER_POOLS[key] = WorkerPool(start_worker, size)
+        return WORKER_POOLS[key]
+
+
+def worker_environ(env):
+    return dict((str(k), str(v)) for k, v in env['ENV'].items())
+
+
+def get_node_worker_pool(env):
+    node = env.WhereIs(env['NODE']) or env['NODE']
+    environ = worker_environ(env)
+    return get_worker_pool(('node', node),
+                           lambda: NodeWorker(node, environ))
+
+
+def node_worker_action(tool, options, command):
+    """Returns an action compiling the sources on a resident node worker.
+
+    If the worker cannot handle the job (the compiler module is missing or
+    reports an error), command is run instead, so errors are reported exactly
+    like without workers."""
+    def compile_on_worker(target, source, env):
+        job = {'tool': tool,
+               'sources': [src.get_abspath() for src in source],
+               'options': options}
+        try:
+            output = get_node_worker_pool(env).run(job)
+        except WorkerError:
+            # the command has been printed already
+            return env.Execute(Action(command, cmdstr=None))
+
+        with io.open(target[0].get_abspath(), 'w', encoding='utf8') as out:
+            out.write(output)
+        return 0
+
+    return Action(compile_on_worker,
+                  strfunction=lambda target, source, env: command)
+
+
+def use_node_worker(env, for_signature):
+    return env['WEB_NODE_WORKERS'] and not for_signature
+
+
+#################################################
+# BATCHES
+#################################################
+# with WEB_BATCH_SIZE > 1, out of date targets of the Less, Coffee and
+# HtmlComp builders are grouped into batches compiled by a single process.
+# Only targets built from a single source are batched, all targets of a batch
+# share the target directory and the environment (HtmlComp: the command line).
+# Batch actions only remove and build $CHANGED_TARGETS, targets that are up
+# to date are left alone
+BATCH_COUNTS = globals().get('BATCH_COUNTS', {})
+
+
+def batchable(tool, env, target, source):
+    if env['WEB_BATCH_SIZE'] < 2 or len(target) != len(source):
+        return False
+    if tool == 'coffee':
+        # coffee -o names its outputs after the sources
+        return all(tgt.name == os.path.splitext(src.name)[0] + '.js'
+                   for tgt, src in zip(target, source))
+    return True
+
+
+def web_batch_key(tool, env, target, source, group=None):
+    """Returns the batch key of a target, starting a new batch every
+    WEB_BATCH_SIZE targets. Targets are batched if they share tool, target
+    directory and group, which defaults to the environment."""
+    if len(target) != 1 or not batchable(tool, env, target, source):
+        return None
+    # targets are created as entries, which never count as up to date when
+    # SCons collects the $CHANGED_TARGETS of a batch
+    target[0].disambiguate()
+    key = (tool, id(env) if group is None else group, target[0].dir)
+    count = BATCH_COUNTS.get(key, 0)
+    BATCH_COUNTS[key] = count + 1
+    return key + (count // env['WEB_BATCH_SIZE'],)
+
+
+# SCons binds batch keys as methods of the action, which needs plain functions
+def less_batch_key(action, env, target, source):
+    return web_batch_key('less', env, target, source)
+
+
+def coffee_batch_key(action, env, target, source):
+    return web_batch_key('coffee', env, target, source)
+
+
+def htmlcomp_batch_key(action, env, target, source):
+    # environments resolving to the same command line share batches. Sources
+    # are grouped by directory, as htmlcompressor names outputs after them
+    group = (' '.join(htmlcomp_command(env, target[0])), source[0].dir,
+             bool(env['WEB_JAVA_WORKERS']))
+    return web_batch_key('htmlcomp', env, target, source, group)
+
+
+BATCH_KEYS = {'less': less_batch_key, 'coffee': coffee_batch_key,
+              'htmlcomp': htmlcomp_batch_key}
+
+
+def changed_batches(target, source):
+    """Returns the (target, source) pairs of a batch that are out of date,
+    like $CHANGED_TARGETS and $CHANGED_SOURCES."""
+    return [(tgt, src) for tgt, src in zip(target, source)
+            if tgt.always_build or not tgt.is_up_to_date()]
+
+
+def node_batch_action(tool, options, command_for):
+    """Returns an action compiling a batch on a single node process.
+
+    Uses the resident workers if enabled, otherwise a node process started
+    for this batch. Targets the worker cannot compile are built by running
+    command_for(target, source) instead."""
+    def compile_batch(target, source, env):
+        if env['WEB_NODE_WORKERS']:
+            pool = get_node_worker_pool(env)
+        else:
+            node = env.WhereIs(env['NODE']) or env['NODE']
+            environ = worker_environ(env)
+            pool = WorkerPool(lambda: NodeWorker(node, environ), 1)
+
+        status = 0
+        try:
+            for tgt, src in changed_batches(target, source):
+                job = {'tool': tool,
+                       'sources': [src.get_abspath()],
+                       'options': options}
+                try:
+                    output = pool.run(job)
+                except WorkerError:
+                    # the command has been printed already
+                    status = env.Execute(Action(command_for(tgt, src),
+                                                cmdstr=None)) or status
+                    continue
+
+                with io.open(tgt.get_abspath(), 'w', encoding='utf8') as out:
+                    out.write(output)
+        finally:
+            if not env['WEB_NODE_WORKERS']:
+                pool.close()
+        return status
+
+    def batch_string(target, source, env):
+        return '\n'.join(command_for(tgt, src)
+                         for tgt, src in changed_batches(target, source))
+
+    return Action(compile_batch, strfunction=batch_string,
+                  batch_key=BATCH_KEYS[tool], targets='$CHANGED_TARGETS')
+
+
+#################################################
+# JVM WORKERS
+#################################################
+# runs the command line entry points of the Closure Compiler and the HTML
+# Compressor inside a resident JVM. Each job is a line of NUL separated
+# arguments, the first one naming the tool; the answer is a line holding the
+# exit status and the length of the captured console output, followed by the
+# output. The entry points are called through reflection to keep them from
+# calling System.exit(). Started with the single-file source launcher, which
+# requires Java 11 or later
+JAVA_WORKER_SOURCE = r"""
+import java.io.*;
+import java.lang.reflect.*;
+import java.nio.charset.StandardCharsets;
+import java.util.Arrays;
+
+public class SConsJavaWorker {
+    public static void main(String[] argv) throws IOException {
+        BufferedReader in = new BufferedReader(
+            new InputStreamReader(System.in, StandardCharsets.UTF_8));
+        PrintStream out = System.out;
+        PrintStream err = System.err;
+        String line;
+        while ((line = in.readLine()) != null) {
+            String[] job = line.split("\u0000", -1);
+            ByteArrayOutputStream buffer = new ByteArrayOutputStream();
+            PrintStream capture = new PrintStream(buffer, true, "UTF-8");
+            System.setOut(capture);
+            System.setErr(capture);
+            int status;
+            try {
+                status = run(job[0], Arrays.copyOfRange(job, 1, job.length));
+            } catch (Throwable t) {
+                t.printStackTrace(capture);
+                status = -1;
+            } finally {
+                capture.flush();
+                System.setOut(out);
+                System.setErr(err);
+            }
+            byte[] output = buffer.toByteArray();
+            out.write((status + " " + output.length + "\n")
+                      .getBytes(StandardCharsets.UTF_8));
+            out.write(output);
+            out.flush();
+        }
+    }
+
+    static Method findMethod(Class<?> cls, String name) throws Exception {
+        for (Class<?> c = cls; c != null; c = c.getSuperclass()) {
+            for (Method m : c.getDeclaredMethods()) {
+                if (m.getName().equals(name)
+                    && m.getParameterTypes().length == 0) {
+                    m.setAccessible(true);
+                    return m;
+                }
+            }
+        }
+        throw new NoSuchMethodException(name);
+    }
+
+    static int run(String tool, String[] args) throws Exception {
+        if (tool.equals("closure")) {
+            Class<?> cls = Class.forName(
+                "com.google.javascript.jscomp.CommandLineRunner");
+            Constructor<?> init = cls.getDeclaredConstructor(String[].class);
+            init.setAccessible(true);
+            Object runner = init.newInstance((Object) args);
+            if (!(Boolean) findMethod(cls, "shouldRunCompiler").invoke(runner))
+                return -1;
+            return (Integer) findMethod(cls, "doRun").invoke(runner);
+        }
+        if (tool.equals("htmlcomp")) {
+            Class<?> cls = Class.forName(
+                "com.googlecode.htmlcompressor.CmdLineCompressor");
+            Object compressor = cls.getConstructor(String[].class)
+                .newInstance((Object) args);
+            findMethod(cls, "process").invoke(compressor);
+            return 0;
+        }
+        throw new IllegalArgumentException("unknown tool " + tool);
+    }
+}
+"""
+
+JAVA_WORKER_SOURCE_DIR = globals().get('JAVA_WORKER_SOURCE_DIR', [])
+
+
+def java_worker_source():
+    """Returns the path of the worker source, written once per process."""
+    with WORKER_POOLS_LOCK:
+        if not JAVA_WORKER_SOURCE_DIR:
+            path = tempfile.mkdtemp(prefix='scons-java-worker-')
+            atexit.register(shutil.rmtree, path, True)
+            with open(os.path.join(path, 'SConsJavaWorker.java'), 'w') as f:
+                f.write(JAVA_WORKER_SOURCE)
+            JAVA_WORKER_SOURCE_DIR.append(path)
+        return os.path.join(JAVA_WORKER_SOURCE_DIR[0], 'SConsJavaWorker.java')
+
+
+class JavaWorker(NodeWorker):
+    """A JVM with a jar on its classpath, running one job at a time."""
+
+    def __init__(self, java, jar, environ):
+        self.process = subprocess.Popen(java + ['-cp', jar,
+                                                java_worker_source()],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        env=environ)
+
+    def run(self, job):
+        try:
+            self.process.stdin.write('\0'.join(job).encode('utf8') + b'\n')
+            self.process.stdin.flush()
+            header = self.process.stdout.readline()
+            status, length = [int(n) for n in header.split()]
+            output = self.process.stdout.read(length)
+        except (IOError, OSError, ValueError):
+            raise WorkerCrashed('worker exited with %s' % self.process.wait())
+
+        if status:
+            raise WorkerError(output.decode('utf8', 'replace'))
+        return output.decode('utf8', 'replace')
+
+
+def java_worker_count(env):
+    return env['JAVA_WORKERS'] or GetOption('num_jobs') or 1
+
+
+def get_java_worker_pool(env, jar):
+    java = shlex.split(env['JAVA'])
+    java[0] = env.WhereIs(java[0]) or java[0]
+    jar = os.path.abspath(os.path.expanduser(jar))
+    environ = worker_environ(env)
+    return get_worker_pool(('java', tuple(java), jar),
+                           lambda: JavaWorker(java, jar, environ),
+                           java_worker_count(env))
+
+
+def java_worker_action(tool, cmd):
+    """Returns an action running the java -jar command line cmd on a resident
+    JVM.
+
+    The arguments following the jar are passed to the tool's entry point as
+    the shell would pass them. If the job fails, the command is run instead,
+    so errors are reported exactly like without workers."""
+    jar = cmd[2]
+    command = ' '.join(cmd)
+    args = shlex.split(command)[len(shlex.split(' '.join(cmd[:3]))):]
+
+    def run_on_worker(target, source, env):
+        try:
+            output = get_java_worker_pool(env, jar).run([tool] + args)
+        except WorkerError:
+            # the command has been printed already
+            return env.Execute(Action(command, cmdstr=None))
+
+        if output:
+            sys.stdout.write(output)
+        return 0
+
+    return Action(run_on_worker,
+                  strfunction=lambda target, source, env: command)
+
+
+def use_java_worker(env, for_signature):
+    return env['WEB_JAVA_WORKERS'] and not for_signature
+
+
 def lessc_generator(source, target, env, for_signature):
     if not env['LESS_COMPILER'] in ('lessc', 'recess'):
         raise Error('Less compiler %s not known' % env['LESS_COMPILER'])
@@ -188,12 +1372,37 @@ def lessc_generator(source, target, env, for_signature):
                         env['LESS_COMPILER'])
         cmd.append('--strict-imports')
 
+    options = {'paths': list(env['LESS_INCLUDE_PATH']),
+               'compress': bool(env['LESS_COMPRESS']),
+               'strictImports': bool(env['LESS_STRICT_IMPORTS'])}
+
+    if env['LESS_COMPILER'] == 'lessc' and batchable('less', env, target,
+                                                     source):
+        if for_signature:
+            # sources and targets are tracked by the nodes, listing them
+            # would change the signature whenever a batch changes
+            fingerprint = tool_fingerprint(env, env['LESS_COMPILER'])
+            return Action(signed_command(' '.join(cmd), fingerprint),
+                          batch_key=less_batch_key,
+                          targets='$CHANGED_TARGETS')
+        command_for = lambda tgt, src: ' '.join(cmd + ['"%s"' % src,
+                                                       '"%s"' % tgt])
+        return node_batch_action('less', options, command_for)
+
     cmd.append('"%s"' % source[0])
     cmd.append('"%s"' % target[0])
 
+    if use_node_worker(env, for_signature) and env['LESS_COMPILER'] == 'lessc':
+        return node_worker_action('less', options, ' '.join(cmd))
+
+    if for_signature:
+        return signed_command(' '.join(cmd),
+                              tool_fingerprint(env, env['LESS_COMPILER']))
+
     return ' '.join(cmd)
 
 BUILDERS['Less'] = Builder(generator=lessc_generator,
+                           emitter=asset_emitter,
                            suffix='.css',
                            src_suffix='.less',
                            single_source=True)
@@ -219,14 +1428,43 @@ def coffee_generator(source, target, env, for_signature):
     if env['COFFEE_BARE']:
         cmd.append('-b')
 
+    options = {'bare': bool(env['COFFEE_BARE'])}
+
+    if batchable('coffee', env, target, source):
+        if use_node_worker(env, for_signature):
+            command_for = lambda tgt, src: ' '.join(cmd + ['"%s"' % src,
+                                                           '> "%s"' % tgt])
+            return node_batch_action('coffee', options, command_for)
+        # coffee compiles the whole batch into the target directory
+        cmd.remove('-p')
+        cmd.append('-o "%s"' % target[0].dir)
+        # sources are tracked by the nodes, listing them would change the
+        # signature whenever a batch changes
+        if for_signature:
+            command = signed_command(' '.join(cmd),
+                                     tool_fingerprint(env, 'coffee'))
+        else:
+            command = ' '.join(cmd + ['$CHANGED_SOURCES'])
+        return Action(command, batch_key=coffee_batch_key,
+                      targets='$CHANGED_TARGETS')
+
     cmd.extend('"%s"' % src for src in source)
     cmd.append('> "%s"' % target[0])
+
+    if use_node_worker(env, for_signature):
+        return node_worker_action('coffee', options, ' '.join(cmd))
+
+    if for_signature:
+        return signed_command(' '.join(cmd), tool_fingerprint(env, 'coffee'))
+
     return ' '.join(cmd)
 
 BUILDERS['Coffee'] = Builder(generator=coffee_generator,
                              suffix='.js', src_suffix='.coffee')
 DEFAULTS['COFFEE_ROOT'] = Dir('.')
 DEFAULTS['COFFEE_BARE'] = False
+# do not scan minified (vendored or bundled) scripts for requirements
+DEFAULTS['COFFEE_SKIP_MINIFIED'] = True
 
 
 def uglifyjs_generator(source, target, env, for_signature):
@@ -242,7 +1480,7 @@ def uglifyjs_generator(source, target, env, for_signature):
     if env['UGLIFY_COMPRESS']:
         cmd.append('--compress')
 
-    if env['UGLIFY_COMPRESS']:
+    if env['UGLIFY_MANGLE']:
         cmd.append('--mangle')
 
     if env['UGLIFY_BEAUTIFY']:
@@ -253,9 +1491,21 @@ def uglifyjs_generator(source, target, env, for_signature):
 
     cmd.append('-o "%s"' % target[0])
 
+    # linting is only available on the command line
+    if use_node_worker(env, for_signature) and not env['UGLIFY_LINT']:
+        options = {'compress': bool(env['UGLIFY_COMPRESS']),
+                   'mangle': bool(env['UGLIFY_MANGLE']),
+                   'output': {'beautify': bool(env['UGLIFY_BEAUTIFY']),
+                              'comments': env['UGLIFY_COMMENTS'] or False}}
+        return node_worker_action('uglifyjs', options, ' '.join(cmd))
+
+    if for_signature:
+        return signed_command(' '.join(cmd), tool_fingerprint(env, 'uglifyjs'))
+
     return ' '.join(cmd)
 
 BUILDERS['UglifyJs'] = Builder(generator=uglifyjs_generator,
+                               emitter=asset_emitter,
                                suffix='.min.js', src_suffic='.js')
 DEFAULTS['UGLIFY_COMMENTS'] = None
 DEFAULTS['UGLIFY_COMPRESS'] = True
@@ -276,16 +1526,32 @@ def closure_generator(source, target, env, for_signature):
     cmd.append('--js_output_file "%s"' % target[0])
     cmd.extend('--js "%s"' % src for src in source)
 
-    return ' '.join(cmd)
+    fingerprint = tool_fingerprint(env, env['JAVA'], cmd[2])
+    if for_signature:
+        return signed_command(' '.join(cmd), fingerprint)
+
+    if use_java_worker(env, for_signature):
+        action = java_worker_action('closure', cmd)
+    else:
+        action = ' '.join(cmd)
+
+    if use_output_cache(env, for_signature):
+        return output_cache_action(action, ' '.join(cmd), fingerprint)
+
+    return action
 
 BUILDERS['Closure'] = Builder(generator=closure_generator,
-                                suffix='.min.js', src_suffic='.js')
+                              emitter=asset_emitter,
+                              suffix='.min.js', src_suffic='.js')
 
 DEFAULTS['CLOSURE_COMPILATION_LEVEL'] = 'ADVANCED_OPTIMIZATIONS'
 DEFAULTS['CLOSURE_FLAGS'] = []
 
 
-def htmlcomp_generator(source, target, env, for_signature):
+def htmlcomp_command(env, target):
+    """Returns the htmlcompressor command line for target, without input and
+    output. Options that are not set are taken from the aggressive or safe
+    option set."""
     cmd = [env['JAVA'], '-jar', get_jar(env, 'HTMLCOMP_COMPRESSOR_JAR')]
 
     opt_level_trans = {
@@ -294,7 +1560,7 @@ def htmlcomp_generator(source, target, env, for_signature):
         'ADVANCED_OPTIMIZATIONS': 'advanced',
     }
 
-    is_xml = str(target[0]).endswith('.xml')
+    is_xml = str(target).endswith('.xml')
 
     def_opt_set = env['HTMLCOMP_AGGRESSIVE_OPTIONS']\
                   if env['HTMLCOMP_AGGRESSIVE'] else\
@@ -305,10 +1571,11 @@ def htmlcomp_generator(source, target, env, for_signature):
 
         if val == None:
             return def_opt_set[name]
+        return val
 
     if env['HTMLCOMP_CHARSET']:
         cmd.append('--charset')
-        cmd.append(env['HTML_CHARSET'])
+        cmd.append(env['HTMLCOMP_CHARSET'])
 
     if get_opt('HTMLCOMP_PRESERVE_COMMENTS'):
         cmd.append('--preserve-comments')
@@ -355,20 +1622,138 @@ def htmlcomp_generator(source, target, env, for_signature):
         if get_opt('HTMLCOMP_COMPRESS_CSS') == 'yui':
             cmd.append('--compress-css')
 
+    return cmd
+
+
+def htmlcomp_batch_action(cmd):
+    """Returns an action compressing the changed targets of a batch with a
+    single htmlcompressor run. htmlcompressor writes the outputs into a
+    temporary directory, named like the sources, from where they are moved to
+    the targets."""
+    def compress_batch(target, source, env):
+        changed = changed_batches(target, source)
+        tmpdir = tempfile.mkdtemp(prefix='.htmlcomp-',
+                                  dir=target[0].dir.get_abspath())
+        try:
+            batch_cmd = (cmd + ['"%s"' % src for tgt, src in changed] +
+                         ['-o "%s/"' % tmpdir])
+            if use_java_worker(env, False):
+                action = java_worker_action('htmlcomp', batch_cmd)
+            else:
+                action = Action(' '.join(batch_cmd))
+            status = action(target, source, env)
+            if status:
+                return status
+
+            for tgt, src in changed:
+                shutil.move(os.path.join(tmpdir, src.name), tgt.get_abspath())
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        return 0
+
+    # the command including the temporary directory is printed when it runs
+    return Action(compress_batch, strfunction=None,
+                  batch_key=htmlcomp_batch_key, targets='$CHANGED_TARGETS')
+
+
+def htmlcomp_generator(source, target, env, for_signature):
+    cmd = htmlcomp_command(env, target[0])
+
+    if batchable('htmlcomp', env, target, source):
+        if for_signature:
+            # sources and targets are tracked by the nodes
+            fingerprint = tool_fingerprint(env, env['JAVA'], cmd[2])
+            return Action(signed_command(' '.join(cmd), fingerprint),
+                          batch_key=htmlcomp_batch_key,
+                          targets='$CHANGED_TARGETS')
+        return htmlcomp_batch_action(cmd)
+
     cmd.append('"%s"' % source[0])
     cmd.append('-o "%s"' % target[0])
 
+    if use_java_worker(env, for_signature):
+        return java_worker_action('htmlcomp', cmd)
+
+    if for_signature:
+        return signed_command(' '.join(cmd),
+                              tool_fingerprint(env, env['JAVA'], cmd[2]))
+
     return ' '.join(cmd)
 
 BUILDERS['HtmlComp'] = Builder(generator=htmlcomp_generator,
+                               emitter=asset_emitter,
                                suffix='.min.html', src_suffix='.html',
                                single_source=True)
 
 
-BUILDERS['AngularTemplates'] = Builder(action='ngtpl --wrapper $NGTPL_WRAPPER '
-                                              '$SOURCES > $TARGET',
+# with NGTPL_NATIVE set, templates are bundled in-process. Each template is
+# wrapped on its own and the fragments are kept in the scan cache, keyed by
+# the content signature of the template, so after editing one template the
+# bundle is assembled from one new fragment and cached ones. Template ids are
+# paths relative to NGTPL_ROOT. The html wrapper emits ng-template script
+# tags, the js wrapper fills the $templateCache of the NGTPL_MODULE module
+NGTPL_JS_HEADER = ("angular.module(%s).run(['$templateCache', "
+                   "function($templateCache) {\n")
+NGTPL_JS_FOOTER = '}]);\n'
+
+
+def js_string(value):
+    # </script> must not end a surrounding script tag
+    return json.dumps(value).replace('</', '<\\/')
+
+
+def wrap_template(wrapper, template_id, contents):
+    if wrapper == 'html':
+        return ('<script type="text/ng-template" id="%s">%s</script>\n' %
+                (template_id.replace('&', '&amp;').replace('"', '&quot;'),
+                 contents))
+    if wrapper == 'js':
+        return '  $templateCache.put(%s, %s);\n' % (js_string(template_id),
+                                                    js_string(contents))
+    raise BuildError(errstr='Unknown NGTPL_WRAPPER %s' % wrapper)
+
+
+def template_fragment(env, node, template_id):
+    wrapper = env['NGTPL_WRAPPER']
+    compute = lambda: wrap_template(wrapper, template_id,
+                                    node.get_text_contents())
+    cache = get_scan_cache(env)
+    if cache is None:
+        return compute()
+    return cache.get('ngtpl:%s:%s:%s' % (wrapper, template_id,
+                                         node.get_csig()), compute)
+
+
+def bundle_templates(target, source, env):
+    root = env.Dir(env['NGTPL_ROOT'])
+    fragments = [template_fragment(env, src, src.get_path(root))
+                 for src in source]
+    if env['NGTPL_WRAPPER'] == 'js':
+        fragments = ([NGTPL_JS_HEADER % js_string(env['NGTPL_MODULE'])] +
+                     fragments + [NGTPL_JS_FOOTER])
+
+    # fragments read from the scan cache are unicode, new ones are not
+    with open(target[0].get_abspath(), 'wb') as out:
+        for fragment in fragments:
+            if not isinstance(fragment, bytes):
+                fragment = fragment.encode('utf8')
+            out.write(fragment)
+
+
+def ngtpl_generator(source, target, env, for_signature):
+    if not env['NGTPL_NATIVE']:
+        return 'ngtpl --wrapper $NGTPL_WRAPPER $SOURCES > $TARGET'
+    if for_signature:
+        # sources are tracked by the nodes
+        return 'bundle_templates $NGTPL_WRAPPER $NGTPL_MODULE $NGTPL_ROOT'
+    return Action(bundle_templates, 'Bundling templates into $TARGET')
+
+BUILDERS['AngularTemplates'] = Builder(generator=ngtpl_generator,
                                        suffix='.html', src_suffix='.html')
 DEFAULTS['NGTPL_WRAPPER'] = 'html'
+DEFAULTS['NGTPL_NATIVE'] = False
+DEFAULTS['NGTPL_ROOT'] = '.'
+DEFAULTS['NGTPL_MODULE'] = 'templates'
 
 
 DEFAULTS['JAVA'] = 'java'
@@ -411,9 +1796,43 @@ DEFAULTS['HTMLCOMP_COMPRESS_JS'] = None
 DEFAULTS['HTMLCOMP_COMPRESS_CSS'] = None
 
 
+# compile Less, Coffee and UglifyJs targets on resident node processes,
+# instead of starting a new one for every target
+DEFAULTS['WEB_NODE_WORKERS'] = False
+DEFAULTS['NODE'] = 'node'
+
+# run Closure and HtmlComp targets on resident JVMs (Java 11 or later). At
+# most JAVA_WORKERS of them are started, by default one per job (-j)
+DEFAULTS['WEB_JAVA_WORKERS'] = False
+DEFAULTS['JAVA_WORKERS'] = None
+
+# compile up to WEB_BATCH_SIZE out of date Less and Coffee targets with a
+# single process. 1 compiles every target on its own
+DEFAULTS['WEB_BATCH_SIZE'] = 1
+
+# directory caching the outputs of Closure and Dart2Js, e.g.
+# '~/.cache/scons-outputs'. None disables caching. OUTPUT_CACHE_SHARED names
+# another cache directory, which is only read from
+DEFAULTS['OUTPUT_CACHE_DIR'] = None
+DEFAULTS['OUTPUT_CACHE_SIZE'] = 1024 ** 3
+DEFAULTS['OUTPUT_CACHE_SHARED'] = None
+
+# package map used to resolve package: dependencies of Dart2Js targets. None
+# searches for .dart_tool/package_config.json or .packages
+DEFAULTS['DART_PACKAGE_MAP'] = None
+
+# path of the scan cache, e.g. '#.webscan.json'. None disables caching
+DEFAULTS['WEB_SCAN_CACHE'] = None
+# print hit/miss statistics of the scan cache at exit
+DEFAULTS['WEB_SCAN_CACHE_STATS'] = False
+# entries unused in this many writes of the scan cache are dropped
+DEFAULTS['WEB_SCAN_CACHE_GENERATIONS'] = 10
+
+
 def generate(env):
     env.Append(BUILDERS=BUILDERS, SCANNERS=SCANNERS)
     env.SetDefault(**DEFAULTS)
+    env.AddMethod(scan_cache_stats, 'WebScanCacheStats')
 
 
 def exists(env):